@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# Measures loading the meta data cache for a large synthetic API, in both
+# the legacy JSON format and the indexed format of compressed records.
+# Each load runs in a fresh interpreter, which loads the cache and decodes
+# the meta data of one top-level component, as the client does for a
+# command. Reports the file size, the time for the load, and the process'
+# maximum resident set size.
+#
+# Usage: PYTHONPATH=. python3 bench/meta_cache.py [--resources N] [--components N]
+
+import argparse
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import client.meta
+
+# Base URL of the synthetic API.
+_BaseURL = "https://device/api/"
+
+def _resource(index, components):
+    """Returns the meta data of a synthetic resource."""
+    name = "command{}".format(index)
+    component = "component{}".format(index % components)
+    text = "Synthetic {} for benchmarking the meta data cache. ".format(name) * 8
+
+    return {
+        "component": [component],
+        "command": name,
+        "resource": "{}{}/{}".format(_BaseURL, component, name),
+        "method": "GET",
+        "summary": "Synthetic command {}".format(index),
+        "description": text,
+        "requires-confirmation": False,
+        "parameters": [{"name": "param{}".format(i), "type": "string", "description": text} for i in range(3)],
+        "request-fields": [],
+        "response-fields": [{"name": "field{}".format(i), "type": "string", "description": text} for i in range(4)],
+        "variables": [],
+        }
+
+def _generate(directory, resources, components):
+    """Writes the synthetic meta data in both formats, returning their paths."""
+    meta = client.meta.Meta("bench")
+    legacy = {}
+
+    for i in range(resources):
+        r = _resource(i, components)
+        meta.add(r["resource"], [r])
+        legacy[r["resource"]] = [r]
+
+    json_path = os.path.join(directory, "cache.json")
+    indexed_path = os.path.join(directory, "cache.indexed")
+
+    with open(json_path, "w") as fp:
+        json.dump({"cache-id": "bench", "resources": legacy}, fp, indent=2, sort_keys=True)
+
+    meta.save(indexed_path)
+    return (json_path, indexed_path)
+
+def _load(path):
+    """Loads a cache and one component; runs in the child process."""
+    start = time.time()
+    meta = client.meta.Meta.load(path)
+    selected = sum(1 for _ in meta.select(["component0"]))
+    secs = time.time() - start
+
+    # Linux reports KiB.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"secs": secs, "rss": rss, "selected": selected}))
+
+def _measure(path):
+    """Loads a cache in a fresh interpreter, returning its measurements."""
+    output = subprocess.check_output([sys.executable, __file__, "--load", path])
+    return json.loads(output.decode("utf8"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading the meta data cache.")
+    parser.add_argument("--resources", type=int, default=5000, help="Number of synthetic resources.")
+    parser.add_argument("--components", type=int, default=40, help="Number of top-level components.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of loads per format; reports the fastest.")
+    parser.add_argument("--load", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        _load(args.load)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = _generate(directory, args.resources, args.components)
+        print("{} resources, {} components".format(args.resources, args.components))
+
+        for (label, path) in zip(("JSON", "indexed"), paths):
+            results = [_measure(path) for _ in range(args.runs)]
+            best = min(results, key=lambda r: r["secs"])
+            size = os.path.getsize(path) / 1024 / 1024
+            print("  {:8} {:6.1f} MiB  {:7.1f} ms  {:6.1f} MB max RSS".format(label, size, best["secs"] * 1000, best["rss"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# Measures uploading a large file through a session's multipart encoder,
+# over a unix domain socket, plain HTTP, and HTTPS. A local server in a
+# separate process receives each upload and discards it, so that only the
+# client's work counts toward the reported CPU time. Reports throughput,
+# the client's CPU seconds, and its maximum resident set size. HTTPS needs
+# the openssl command to create a certificate for the server, and is
+# skipped without it. To compare against an earlier version, run the
+# script with PYTHONPATH pointing to a checkout of it.
+#
+# Usage: PYTHONPATH=. python3 bench/multipart_upload.py [--size MB] [--transport unix|http|https ...]
+
+import argparse
+import json
+import os
+import os.path
+import resource
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import client.argparser
+import client.session
+
+# Path the file is uploaded to. Earlier versions stream a single file
+# through the multipart encoder only for sensor images.
+_Path = "/api/fleet/v1/sensor-update/images"
+
+# Transports to measure by default.
+_Transports = ("unix", "http", "https")
+
+# Size of the blocks the server receives the body in.
+_BlockSize = 1024 * 1024
+
+def _generate(path, size):
+    """Writes a file of a given number of MB that doesn't compress."""
+    block = os.urandom(_BlockSize)
+
+    with open(path, "wb") as fp:
+        for _ in range(size):
+            fp.write(block)
+
+def _certificate(directory):
+    """Creates a self-signed certificate, returning its and its key's paths."""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return (cert, key)
+
+def _receive(conn):
+    """Receives requests on a connection until the client closes it."""
+    buffer = bytearray(_BlockSize)
+    view = memoryview(buffer)
+    pending = b""
+
+    while True:
+        while b"\r\n\r\n" not in pending:
+            data = conn.recv(65536)
+
+            if not data:
+                return
+
+            pending += data
+
+        (head, pending) = pending.split(b"\r\n\r\n", 1)
+        length = 0
+
+        for line in head.split(b"\r\n")[1:]:
+            (name, _, value) = line.partition(b":")
+
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+
+        left = length - len(pending)
+        pending = b""
+
+        while left > 0:
+            n = conn.recv_into(view[:min(left, _BlockSize)])
+
+            if not n:
+                return
+
+            left -= n
+
+        body = json.dumps({"bytes": length}).encode("utf8")
+        conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: application/json; schema=object; version=1; cache=bench\r\n"
+                     + "Content-Length: {}\r\n\r\n".format(len(body)).encode("utf8") + body)
+
+def _serve(transport, address, cert, key):
+    """Runs the server; runs in the child process."""
+    if transport == "unix":
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        address = str(listener.getsockname()[1])
+
+    listener.listen(8)
+
+    if transport == "https":
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+    else:
+        context = None
+
+    print(address, flush=True)
+
+    while True:
+        (conn, _) = listener.accept()
+
+        try:
+            if context:
+                conn = context.wrap_socket(conn, server_side=True)
+
+            _receive(conn)
+
+        except (OSError, ssl.SSLError):
+            pass
+
+        finally:
+            conn.close()
+
+def _session(transport, address):
+    """Returns a session talking to the server, and the URL to upload to."""
+    args = client.argparser.createParser({}).parse_args([])
+    args.bearer_token = "bench"
+    args.noblock = True
+    args.ssl_no_verify_certificate = True
+    args.ssl_no_verify_hostname = True
+
+    if transport == "unix":
+        args.socket = address
+        url = "http://localhost" + _Path
+    else:
+        url = "{}://localhost:{}{}".format(transport, address, _Path)
+
+    return (client.session.Session(args), url)
+
+def _upload(session, url, path):
+    """Uploads the file once, returning wall-clock and CPU seconds."""
+    with open(path, "rb") as fp:
+        start = time.time()
+        cpu = time.process_time()
+        (response, schema, cache, data) = session.retrieveResource(url, method="POST", files={"image": (path, fp)})
+        cpu = time.process_time() - cpu
+        secs = time.time() - start
+
+    if response.status_code != 200 or data["bytes"] <= os.path.getsize(path):
+        raise RuntimeError("upload failed: {} {}".format(response.status_code, data))
+
+    return (secs, cpu)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploading a large file.")
+    parser.add_argument("--size", type=int, default=1024, help="Size of the file in MB.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of uploads per transport; reports the fastest.")
+    parser.add_argument("--transport", action="append", choices=_Transports, help="Transport to measure; all by default.")
+    parser.add_argument("--serve", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        _serve(*args.serve)
+        return
+
+    transports = args.transport or _Transports
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "upload.bin")
+        _generate(path, args.size)
+
+        (cert, key) = ("", "")
+
+        if "https" in transports:
+            if shutil.which("openssl"):
+                (cert, key) = _certificate(directory)
+            else:
+                print("no openssl command, skipping https")
+                transports = [t for t in transports if t != "https"]
+
+        print("{} MB file".format(args.size))
+
+        for transport in transports:
+            address = os.path.join(directory, "server.sock")
+            server = subprocess.Popen([sys.executable, __file__, "--serve", transport, address, cert, key],
+                                      stdout=subprocess.PIPE)
+
+            try:
+                address = server.stdout.readline().decode("utf8").strip()
+                (session, url) = _session(transport, address)
+                results = [_upload(session, url, path) for _ in range(args.runs)]
+
+            finally:
+                server.kill()
+                server.wait()
+
+            (secs, cpu) = min(results)
+            print("  {:6} {:7.0f} MB/s  {:6.2f}s CPU".format(transport, args.size / secs, cpu))
+
+        # Linux reports KiB.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print("  {:.1f} MB max RSS".format(rss))
+
+if __name__ == "__main__":
+    main()
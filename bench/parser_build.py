@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# Measures building the complete argument parser tree for synthetic APIs
+# with growing numbers of commands in a single component, as happens for
+# ``--help`` without a command. Building the tree used to be quadratic in
+# the number of commands; to compare against an earlier version, run the
+# script with PYTHONPATH pointing to a checkout of it.
+#
+# Usage: PYTHONPATH=. python3 bench/parser_build.py [N ...]
+
+import sys
+import time
+
+import client.argparser
+import client.meta
+
+# Numbers of commands to measure by default.
+_Sizes = (250, 500, 1000, 2000)
+
+def _meta(commands):
+    """Returns synthetic meta data with a given number of commands."""
+    meta = client.meta.Meta("bench")
+
+    for i in range(commands):
+        url = "https://device/api/component/command{}".format(i)
+        meta.add(url, [{
+            "component": ["component"],
+            "command": "command{}".format(i),
+            "resource": url,
+            "method": "GET",
+            "schema": "object",
+            "summary": "Synthetic command {}".format(i),
+            "description": "Synthetic command for benchmarking building the parser.",
+            "requires-confirmation": False,
+            "parameters": [{"name": "param", "type": "string", "description": "A parameter."}],
+            "request-fields": [{"name": "field", "type": "string", "description": "A request field."}],
+            "response-fields": [{"name": "result", "type": "string", "description": "A response field."}],
+            "variables": [],
+            }])
+
+    return meta
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or _Sizes
+
+    print("  {:6} {:>10}".format("N", "build"))
+
+    for n in sizes:
+        meta = _meta(n)
+        parser = client.argparser.createParser({})
+
+        # Earlier versions don't reset the component parsers themselves.
+        client.argparser.ComponentParsers.clear()
+
+        start = time.time()
+        client.argparser.populateParser(parser, meta)
+        secs = time.time() - start
+
+        print("  {:6} {:8.0f} ms".format(n, secs * 1000))
+
+if __name__ == "__main__":
+    main()
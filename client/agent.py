@@ -0,0 +1,410 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# A long-lived background process running commands on behalf of the
+# command line front-end. The agent keeps sessions, meta data and command
+# tables in memory between commands, so that each command saves the
+# start-up work and, as long as the device's connection stays open, the
+# TLS handshake.
+#
+# The front-end connects to the agent's unix socket and passes over its
+# standard input, output, and error file descriptors along with a
+# newline-terminated JSON request carrying its command line arguments,
+# environment, and working directory. The agent runs the command with
+# those descriptors in place and replies with the exit code. Commands
+# run one at a time, as they share the process' standard streams,
+# environment and working directory: the agent answers each connection
+# right away with whether it's ready for a command, and a front-end
+# finding it busy runs the command itself without waiting. If the
+# front-end goes away before the command finishes, the agent interrupts
+# the command.
+#
+# This module is imported by the front-end for every invocation, so
+# it avoids importing anything that's expensive to load until the agent
+# itself starts.
+
+import array
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import client.argparser
+import client.configuration
+import client.util
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on all platforms; we then don't use the agent.
+    fcntl = None
+
+# Socket the agent listens on.
+SocketFile = os.path.join(client.configuration.StateDir, "agent.sock")
+
+# Seconds after which an agent without any commands terminates.
+_IdleTimeout = 10 * 60
+
+# Seconds to wait for a newly started agent to accept connections.
+_StartTimeout = 10
+
+# Maximum size of a request's JSON message.
+_MaxRequestSize = 1024 * 1024
+
+# Seconds to wait for the agent to answer a new connection before
+# running the command in-process instead. A responsive agent answers
+# immediately, whether it's ready or busy.
+_AnswerTimeout = 0.5
+
+# Byte the agent sends when it is ready to receive a command.
+_Ready = b"+"
+
+# Byte the agent sends when it is busy with another command.
+_Busy = b"-"
+
+# The file descriptors passed to the agent: stdin, stdout, stderr.
+_StandardFDs = (0, 1, 2)
+
+def enabled(argv):
+    """
+    Returns True if a command should run through the agent, as determined
+    by the ``--agent`` and ``--no-agent`` options and the ``agent``
+    configuration setting.
+
+    argv (list of str): The command line arguments, excluding the program
+    name.
+    """
+    if not fcntl or not hasattr(socket, "AF_UNIX"):
+        return False
+
+    config = {}
+    client.configuration.read(client.configuration.ConfigFileGlobal, config)
+    client.configuration.read(client.configuration.ConfigFile, config)
+
+    parser = client.argparser.createParser(config)
+    (args, remaining) = parser.parse_known_args([a for a in argv if a != "-h" and a != "--help"])
+
+    # A shell keeps its own session around already, and would hold up
+    # the agent for as long as it runs.
+    return args.agent and not args.shell
+
+def run(argv):
+    """
+    Runs a command through the agent, starting the agent first if it isn't
+    running yet.
+
+    argv (list of str): The command line arguments, excluding the program
+    name.
+
+    Returns: The command's exit code, or None if the agent isn't available
+    or is busy with another command. In the latter case, the command has
+    not been run.
+    """
+    for fd in _StandardFDs:
+        try:
+            os.fstat(fd)
+        except OSError:
+            return None
+
+    sock = _connect()
+
+    if not sock:
+        _start()
+        sock = _connect(_StartTimeout)
+
+        if not sock:
+            return None
+
+    request = {
+        "argv": argv,
+        "environ": dict(os.environ),
+        "cwd": os.getcwd(),
+        }
+
+    with sock:
+        sock.settimeout(_AnswerTimeout)
+
+        try:
+            if sock.recv(len(_Ready)) != _Ready:
+                return None
+        except OSError:
+            return None
+
+        sock.settimeout(None)
+
+        data = json.dumps(request).encode("utf8") + b"\n"
+        fds = array.array("i", _StandardFDs)
+        sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+        if sent < len(data):
+            sock.sendall(data[sent:])
+
+        reply = _readLine(sock)
+
+    try:
+        return int(json.loads(reply.decode("utf8"))["exit"])
+    except (ValueError, KeyError, TypeError):
+        client.util.fatalError("agent terminated without completing the command")
+
+def _connect(timeout=0):
+    """
+    Connects to the agent's socket, retrying for up to *timeout* seconds.
+
+    Returns: The connected socket, or None if the agent cannot be reached.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(SocketFile)
+            return sock
+        except OSError:
+            sock.close()
+
+        if time.time() >= deadline:
+            return None
+
+        time.sleep(0.01)
+
+def _start():
+    """Starts an agent process in the background, detached from the terminal."""
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (package_dir, env.get("PYTHONPATH", None)) if p)
+
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen([sys.executable, "-c", "import client.agent; client.agent.serve()"],
+                         stdin=devnull, stdout=devnull, stderr=devnull, cwd="/", env=env,
+                         start_new_session=True)
+
+def _readLine(sock):
+    """Reads a newline-terminated message from a socket, returning it without the newline or b"" on EOF."""
+    data = b""
+
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+
+        if not chunk:
+            return b""
+
+        data += chunk
+
+        if len(data) > _MaxRequestSize:
+            return b""
+
+    return data[:-1]
+
+def serve():
+    """
+    Runs the agent, serving commands until it has been idle for
+    ``_IdleTimeout`` seconds. Returns immediately if another agent is
+    running already.
+    """
+    os.makedirs(client.configuration.StateDir, mode=0o700, exist_ok=True)
+
+    with open(SocketFile + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+
+        # Deferred until here so that the front-end doesn't pay for it.
+        from client import cli
+
+        try:
+            os.unlink(SocketFile)
+        except FileNotFoundError:
+            pass
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+
+        try:
+            listener.bind(SocketFile)
+        finally:
+            os.umask(umask)
+
+        listener.listen(16)
+
+        # Connections are accepted in the background so that front-ends
+        # learn right away when we're busy; the main thread runs the
+        # commands handed over to it.
+        connections = queue.Queue()
+        state = {"busy": False}
+        state_lock = threading.Lock()
+        acceptor = threading.Thread(target=_accept, args=(listener, connections, state, state_lock), daemon=True)
+        acceptor.start()
+
+        while True:
+            try:
+                conn = connections.get(timeout=_IdleTimeout)
+            except queue.Empty:
+                with state_lock:
+                    if state["busy"]:
+                        # A connection came in just now.
+                        continue
+
+                    # Turn away any further connections while terminating.
+                    state["busy"] = True
+                    break
+
+            _serveConnection(conn, cli.main)
+
+            with state_lock:
+                state["busy"] = False
+
+        os.unlink(SocketFile)
+
+def _accept(listener, connections, state, state_lock):
+    """
+    Accepts connections to the agent, handing them to the main thread
+    through *connections* if it's idle, and turning them away otherwise.
+    """
+    while True:
+        try:
+            (conn, addr) = listener.accept()
+        except OSError:
+            return
+
+        with state_lock:
+            if not state["busy"]:
+                state["busy"] = True
+                connections.put(conn)
+                continue
+
+        try:
+            with conn:
+                conn.sendall(_Busy)
+        except OSError:
+            # The front-end went away already.
+            pass
+
+def _serveConnection(conn, main):
+    """Serves a single command received on a connection to the agent."""
+    try:
+        with conn:
+            _handle(conn, main)
+
+    except KeyboardInterrupt:
+        # The front-end went away while the command was running.
+        pass
+
+    except OSError:
+        # The front-end went away while we were talking to it.
+        pass
+
+def _handle(conn, main):
+    """
+    Receives a command on a connection to the agent, runs it through
+    *main*, and sends back its exit code.
+    """
+    conn.sendall(_Ready)
+
+    fds = array.array("i")
+    (data, ancdata, flags, addr) = conn.recvmsg(65536, socket.CMSG_SPACE(len(_StandardFDs) * fds.itemsize))
+
+    for (level, kind, cdata) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+    try:
+        if not data or len(fds) != len(_StandardFDs):
+            return
+
+        if not data.endswith(b"\n"):
+            rest = _readLine(conn)
+
+            if not rest:
+                return
+
+            data += rest + b"\n"
+
+        request = json.loads(data.decode("utf8"))
+
+        # Interrupt the command if the front-end goes away.
+        state = {"done": False}
+        watcher = threading.Thread(target=_watch, args=(conn, state, threading.main_thread().ident), daemon=True)
+        watcher.start()
+
+        try:
+            status = _run(main, request, fds)
+        finally:
+            state["done"] = True
+            conn.shutdown(socket.SHUT_RD)
+            watcher.join()
+
+        conn.sendall(json.dumps({"exit": status}).encode("utf8") + b"\n")
+
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+def _watch(conn, state, main_thread):
+    """Waits for the front-end to close its connection, and interrupts the running command if it does so early."""
+    try:
+        conn.recv(1)
+    except OSError:
+        pass
+
+    if not state["done"]:
+        signal.pthread_kill(main_thread, signal.SIGINT)
+
+def _run(main, request, fds):
+    """
+    Runs a command with the front-end's standard streams, environment and
+    working directory in place.
+
+    Returns: The command's exit code.
+    """
+    # Buffered like the interpreter's own standard streams.
+    streams = (open(fds[0], "r", closefd=False),
+               open(fds[1], "w", buffering=(1 if os.isatty(fds[1]) else -1), closefd=False),
+               open(fds[2], "w", buffering=1, closefd=False, errors="backslashreplace"))
+
+    saved_streams = (sys.stdin, sys.stdout, sys.stderr)
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+
+    (sys.stdin, sys.stdout, sys.stderr) = streams
+    os.environ.clear()
+    os.environ.update(request["environ"])
+    client.util.enableDebug(0)
+
+    try:
+        os.chdir(request["cwd"])
+        status = main(request["argv"])
+
+    except SystemExit as e:
+        status = e.code
+
+        if status is not None and not isinstance(status, int):
+            # Same as the interpreter does for a non-integer exit status.
+            print(status, file=sys.stderr)
+            status = 1
+
+    except Exception:
+        traceback.print_exc()
+        status = 1
+
+    finally:
+        for stream in streams:
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+
+        (sys.stdin, sys.stdout, sys.stderr) = saved_streams
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+
+    return (status if status is not None else 0)
@@ -0,0 +1,426 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# A programmatic interface to a Corelight Sensor or Fleet Manager, for
+# embedding the client into other Python programs.
+#
+# A Client holds one session with the device, along with the device's meta
+# data, and exposes the device's commands as callable operations:
+#
+#     c = client.api.Client(device="sensor.example.com", user="admin", password="...")
+#     info = c.information.get()
+#     c.operation("bro diag")(full=True)
+#
+# Operations take their parameters as keyword arguments, with dashes in
+# names replaced by underscores. They return the decoded response, and
+# report errors through exceptions derived from ClientError instead of
+# printing them and exiting. Clients can be used from multiple threads
+# concurrently, and clients for devices with the same API can share
+# their meta data.
+
+import collections
+import threading
+
+import client.argparser
+import client.cli
+import client.meta
+import client.resource
+import client.session
+
+class ClientError(Exception):
+    """Base class for all errors raised by the API."""
+    def __init__(self, msg, status_code=None):
+        super(ClientError, self).__init__(msg)
+        self.status_code = status_code
+
+class DeviceError(ClientError):
+    """
+    Error communicating with the device, including failing to
+    authenticate.
+    """
+
+class ParameterError(ClientError):
+    """Error with the operation requested, or its parameters."""
+
+class RequestError(ClientError):
+    """
+    Error reported by the device in response to a request. ``status_code``
+    is the response's HTTP status, and ``diagnostics`` any further
+    information the device sent along, or an empty string.
+    """
+    def __init__(self, msg, status_code=None, diagnostics=""):
+        super(RequestError, self).__init__(msg, status_code)
+        self.diagnostics = diagnostics
+
+class ConfirmationRequired(ClientError):
+    """
+    Raised when an operation requires confirmation but has not been
+    invoked with ``confirm=True``. ``message`` is the device's description
+    of what needs to be confirmed.
+    """
+    def __init__(self, message):
+        super(ConfirmationRequired, self).__init__("confirmation required: " + message)
+        self.message = message
+
+# A file that an operation saved: the path it was saved to, and its
+# checksum as a hex string if requested, or None.
+SavedFile = collections.namedtuple("SavedFile", ["path", "checksum"])
+
+class Client:
+    """
+    A connection to a Corelight Sensor, or to a Fleet Manager or a sensor
+    managed through it.
+    """
+    def __init__(self, device=None, fleet=None, uid=None, user=None, password=None, bearer_token=None, mfa=None,
+                 meta=None, cache_file=None, socket=None, ssl_ca_cert=None, ssl_no_verify_certificate=False,
+                 ssl_no_verify_hostname=False, connect_timeout=None, read_timeout=None, retries=None,
+                 meta_workers=None, meta_cache_ttl=0):
+        """
+        Constructor. Connects to the device and retrieves its meta data if
+        not given. Raises ``DeviceError`` if that fails.
+
+        device (str): The network address of a Corelight Sensor, optionally
+        as a URL.
+
+        fleet (str): The network address of a Corelight Fleet Manager,
+        optionally as a URL. Exactly one of *device* and *fleet* must be
+        given.
+
+        uid (str): The UID of a sensor to talk to through *fleet*.
+
+        user (str): User name for authentication.
+
+        password (str): Password for authentication.
+
+        bearer_token (str): Bearer token or API key for authentication.
+
+        mfa (str): 2FA verification code for authentication.
+
+        meta (meta.Meta): The device's meta data, such as from another
+        client for a device with the same API. If not given, it's
+        retrieved from the device.
+
+        cache_file (str): File where to cache the meta data that's
+        retrieved from the device. If not given, it's not cached.
+
+        socket (str): Unix domain socket to use for sending requests.
+
+        ssl_ca_cert (str): Path to CA certificate(s) for verifying the
+        device's identity, or ``system`` for the system's root store.
+        Defaults to Corelight's internal CA.
+
+        ssl_no_verify_certificate (bool): True to not verify the device's
+        certificate.
+
+        ssl_no_verify_hostname (bool): True to not verify the device's
+        hostname for the certificate check.
+
+        connect_timeout (float): Seconds to wait for a connection to the
+        device. Zero means waiting indefinitely.
+
+        read_timeout (float): Seconds to wait for the device to send data.
+        Zero means waiting indefinitely.
+
+        retries (int): Number of times to retry failed requests that are
+        safe to repeat.
+
+        meta_workers (int): Number of concurrent requests when retrieving
+        meta data.
+
+        meta_cache_ttl (int): Seconds to use meta data cached in
+        *cache_file* without checking back with the device.
+        """
+        if bool(device) == bool(fleet):
+            raise ParameterError("either a device or a fleet manager must be given")
+
+        try:
+            (url, scheme, auth_base_url) = client.cli.baseURL(device, fleet, uid)
+        except ValueError as e:
+            raise ParameterError(str(e))
+
+        # The same options that the command line provides, with their
+        # defaults.
+        args = client.argparser.createParser({}).parse_args([])
+        args.device = device
+        args.fleet = fleet
+        args.uid = uid
+        args.user = user
+        args.password = password
+        args.bearer_token = bearer_token
+        args.mfa = mfa
+        args.socket = socket
+        args.ssl_ca_cert = ssl_ca_cert
+        args.ssl_no_verify_certificate = (ssl_no_verify_certificate or bool(socket))
+        args.ssl_no_verify_hostname = (ssl_no_verify_hostname or bool(socket))
+        args.auth_base_url = auth_base_url
+        args.noblock = True
+        args.no_password_save = True
+
+        for (name, value) in (("connect_timeout", connect_timeout), ("read_timeout", read_timeout),
+                              ("retries", retries), ("meta_workers", meta_workers)):
+            if value is not None:
+                setattr(args, name, value)
+
+        self._url = url
+        self._session = client.session.Session(args)
+        self._session.prewarm(url)
+
+        # Serializes saving files, so that concurrent operations don't
+        # pick the same file name.
+        self._save_lock = threading.Lock()
+
+        if meta is None:
+            try:
+                meta = client.meta.load(self._session, url, cache_file=cache_file, workers=args.meta_workers, ttl=meta_cache_ttl)
+            except client.session.SessionError as e:
+                raise DeviceError(str(e), e.status_code)
+
+        self._meta = meta
+        self._table = client.argparser.CommandTable.build(meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the client's connections to the device."""
+        self._session.close()
+
+    def meta(self):
+        """Returns the device's meta data."""
+        return self._meta
+
+    def operations(self):
+        """
+        Returns a sorted list of the paths of all operations that the
+        device provides, such as ``bro diag``.
+        """
+        paths = []
+
+        for (url, index) in self._table.resolve([]):
+            r = self._meta.get(url)[index]
+            paths.append(" ".join(r["component"] + [r["command"]]))
+
+        return sorted(paths)
+
+    def operation(self, path):
+        """
+        Returns an operation that the device provides. Raises
+        ``ParameterError`` if there's no such operation.
+
+        path (str or list of str): The operation's path, such as ``bro
+        diag`` or ``["bro", "diag"]``.
+
+        Returns: An ``Operation``.
+        """
+        if isinstance(path, str):
+            path = path.split()
+
+        for (url, index) in self._table.resolve(path):
+            r = self._meta.get(url)[index]
+
+            if r["component"] + [r["command"]] == path:
+                return Operation(self, r)
+
+        raise ParameterError("unknown operation '{}'".format(" ".join(path)))
+
+    def call(self, path, **values):
+        """
+        Invokes an operation; a shortcut for ``operation(path)(**values)``.
+        """
+        return self.operation(path)(**values)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return _Component(self, [])._child(name)
+
+    def _invoke(self, resource, values, confirm, directory, checksum):
+        """Implements ``Operation.invoke()``."""
+        values = _values(resource, values)
+
+        try:
+            request = client.resource._prepareRequest(self._session, resource, values)
+        except client.resource.ResourceError as e:
+            raise ParameterError(str(e))
+
+        try:
+            return self._send(resource, request, confirm, directory, checksum)
+
+        finally:
+            for file in request["files"].values():
+                if hasattr(file[1], "close"):
+                    file[1].close()
+
+    def _send(self, resource, request, confirm, directory, checksum):
+        """Sends a prepared request, and processes the response."""
+        force_url = None
+
+        while True:
+            try:
+                (response, schema, cache, data) = client.resource._retrieveRequest(self._session, request, force_url)
+
+                if response.status_code == 202:
+                    (response, schema, cache, data) = client.resource._waitForResult(self._session, response, progress=False)
+
+            except client.session.SessionError as e:
+                raise DeviceError(str(e), e.status_code)
+
+            if not 200 <= response.status_code < 300:
+                (error, diagnostics) = client.resource._errorMessage(resource, response, data)
+                raise RequestError(error, response.status_code, diagnostics)
+
+            if schema != "confirmation":
+                return self._result(resource, schema, data, directory, checksum)
+
+            if not confirm:
+                raise ConfirmationRequired(data["message"])
+
+            # Reissue the request with the URL we got.
+            force_url = data["confirmation-url"]
+
+    def _result(self, resource, schema, data, directory, checksum):
+        """Turns a successful response's data into an operation's result."""
+        if schema == "collection":
+            try:
+                return list(data)
+            except client.session.SessionError as e:
+                raise DeviceError(str(e), e.status_code)
+
+        if schema == "object":
+            try:
+                with self._save_lock:
+                    saved = client.resource._saveFiles(resource["response-fields"], data, checksum, directory)
+            except client.resource.ResourceError as e:
+                raise ClientError(str(e))
+
+            data = dict(data)
+            data.update({name: SavedFile(*file) for (name, file) in saved.items()})
+            return data
+
+        if schema == "object-raw":
+            return data
+
+        return None
+
+class Operation:
+    """An operation that the device provides, such as ``bro diag``."""
+    def __init__(self, client_, resource):
+        """
+        Constructor.
+
+        client_ (Client): The client to invoke the operation through.
+
+        resource (dict): The meta information for the operation's
+        resource.
+        """
+        self._client = client_
+        self._resource = resource
+
+    def path(self):
+        """Returns the operation's path, such as ``bro diag``."""
+        return " ".join(self._resource["component"] + [self._resource["command"]])
+
+    def summary(self):
+        """Returns a one-line description of the operation."""
+        return self._resource.get("summary", "")
+
+    def parameters(self):
+        """
+        Returns the names of the keyword arguments that the operation
+        accepts, with dashes replaced by underscores.
+        """
+        return [p["name"].replace("-", "_") for p in _parameters(self._resource)]
+
+    def requiresConfirmation(self):
+        """Returns True if the operation may require confirmation."""
+        return self._resource.get("requires-confirmation", False)
+
+    def __call__(self, **values):
+        """Invokes the operation with parameters; see ``invoke()``."""
+        return self.invoke(values)
+
+    def invoke(self, values=None, confirm=False, directory=None, checksum=None):
+        """
+        Invokes the operation, waiting for it to finish if the device
+        runs it asynchronously.
+
+        values (dict of str to any): The values for the operation's
+        parameters; see ``parameters()``. Parameters of type ``file``
+        take the path of the file to send. Missing ones use their
+        defaults.
+
+        confirm (bool): True to proceed if the device asks for
+        confirmation. Otherwise, ``ConfirmationRequired`` is raised.
+
+        directory (str): Directory where to save files that the response
+        contains. Defaults to the current directory. Existing files are
+        never overwritten; a new file gets a numbered suffix instead.
+
+        checksum (str): If given, the name of a ``hashlib`` algorithm to
+        compute a checksum of each saved file with.
+
+        Returns: The response's data: a list for collections, a dictionary
+        for objects, with any files replaced by ``SavedFile`` tuples, or
+        None for responses without data. Raises an exception derived from
+        ``ClientError`` if the operation fails.
+        """
+        return self._client._invoke(self._resource, values, confirm, directory, checksum)
+
+    def __repr__(self):
+        return "<Operation {}>".format(self.path())
+
+class _Component:
+    """Attribute access to the operations below a component."""
+    def __init__(self, client_, path):
+        self._client = client_
+        self._path = path
+
+    def _child(self, name):
+        for word in (name, name.replace("_", "-")):
+            path = self._path + [word]
+
+            if self._client._table.complete(path):
+                return _Component(self._client, path)
+
+            try:
+                return self._client.operation(path)
+            except ParameterError:
+                pass
+
+        raise AttributeError(" ".join(self._path + [name]))
+
+    def __getattr__(self, name):
+        return self._child(name)
+
+def _parameters(resource):
+    """Returns all parameters, fields, and variables that a resource takes."""
+    return resource.get("parameters", []) + resource.get("request-fields", []) + resource.get("variables", [])
+
+def _values(resource, values):
+    """
+    Builds the complete set of values for a request, filling in defaults.
+    Raises ``ParameterError`` for unknown or missing values.
+    """
+    given = dict(values or {})
+    result = {}
+
+    for p in _parameters(resource):
+        name = p["name"]
+        key = name.replace("-", "_")
+        value = given.pop(key, p.get("default", None))
+
+        if value is None and (p.get("required", False) or p in resource.get("variables", [])):
+            raise ParameterError("missing value for parameter '{}'".format(key))
+
+        result[key] = value
+        result[name] = value
+
+    if given:
+        raise ParameterError("unknown parameters: {}".format(", ".join(sorted(given))))
+
+    return result
@@ -2,6 +2,7 @@
 #
 # See COPYING for license information.
 import argparse
+import json
 import re
 import sys
 import textwrap
@@ -36,6 +37,21 @@ _re_squotes = re.compile("`([^`]+)`")
 _re_backticks = re.compile("``([^']+)''")
 _false_equivalent_strings = [ "False", "false", "0", "FALSE" ]
 
+# Default number of concurrent requests when downloading meta data.
+_DefaultMetaWorkers = 8
+
+# Default seconds to wait for a connection to the device to be established.
+_DefaultConnectTimeout = 10
+
+# Default seconds to wait for the device to send data.
+_DefaultReadTimeout = 300
+
+# Default number of times to retry a failed request that's safe to repeat.
+_DefaultRetries = 3
+
+# Algorithms supported for checksums of saved files.
+_ChecksumAlgorithms = ("md5", "sha1", "sha256", "sha512")
+
 def _display(txt):
     """
     Process a string that may contain reST control sequence for
@@ -119,17 +135,35 @@ class ComponentArgumentParser(argparse.ArgumentParser):
     def addResource(self, resource):
         """
         Adds a resource to the ones associated with this components. This then
-        also updates the usage message. It also updates the parent parser.
+        also updates the usage message, and invalidates the epilog. It also
+        updates the parent parser.
 
         resource (list of dict): List of the resource meta dictionaries.
         """
         self._resources.append(resource)
         self.usage = self.format_usage()
-        self.epilog = self.help_epilog()
+
+        # Recomputed on demand.
+        self._epilog = None
 
         if self._parent:
             self._parent.addResource(resource)
 
+    @property
+    def epilog(self):
+        """
+        Overridden from base class to compute the list of commands only
+        once help is actually shown.
+        """
+        if self._epilog is None and self._resources:
+            self._epilog = self.help_epilog()
+
+        return self._epilog
+
+    @epilog.setter
+    def epilog(self, epilog):
+        self._epilog = epilog
+
     def addComponentParser(self, name):
         """Adds a new subparsers with a given name."""
         return self.componentParsers().add_parser(name)
@@ -284,19 +318,47 @@ class CommandArgumentParser(argparse.ArgumentParser):
 
     def finalizeResource(self):
         """
-        Finalizes intializing the resources. This then also updates the usage
-        message.
+        Finalizes intializing the resources. This adds the options for the
+        request fields, and invalidates the description and epilog, which
+        are then computed once help is actually shown.
 
         resource (dict): The resource meta dictionaries.
         """
-        summary = _wrap(_display(self._resource.get("summary", "")))
-        description = _wrap(_display(self._resource.get("description", "")))
+        for f in self._request_fields:
+            _buildArgument(self, f)
+
+        self._description = None
+        self._epilog = None
+
+    @property
+    def description(self):
+        """Overridden from base class to compute the text on demand."""
+        if self._description is None and self._resource:
+            summary = _wrap(_display(self._resource.get("summary", "")))
+            description = _wrap(_display(self._resource.get("description", "")))
+
+            if self._resource.get("requires-confirmation", True):
+                description += " Before executing the operation, the command will request explicit confirmation."
+
+            self._description = "{}\n\n{}".format(summary, description)
+
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+
+    @property
+    def epilog(self):
+        """Overridden from base class to compute the text on demand."""
+        if self._epilog is None and self._resource:
+            self._epilog = self.help_epilog()
 
-        if self._resource.get("requires-confirmation", True):
-            description += " Before executing the operation, the command will request explicit confirmation."
+        return self._epilog
 
-        self.description = "{}\n\n{}".format(summary, description)
-        self.epilog = self.help_epilog()
+    @epilog.setter
+    def epilog(self, epilog):
+        self._epilog = epilog
 
     def parent(self):
         """
@@ -367,9 +429,6 @@ class CommandArgumentParser(argparse.ArgumentParser):
 
     def help_epilog(self):
         """Overridden from base class."""
-        for f in self._request_fields:
-            _buildArgument(self, f)
-
         if not self._response_fields:
             return
 
@@ -406,6 +465,30 @@ class CommandArgumentParser(argparse.ArgumentParser):
         print("{} error: {}".format(client.NAME, message), file=sys.stderr)
         self.exit(1)
 
+def _intOption(config, option, default):
+    """
+    Retrieves an integer value from the configuration, aborting if it cannot
+    be parsed.
+    """
+    value = config.get(option, default)
+
+    try:
+        return int(value)
+    except ValueError:
+        client.util.fatalError("option '{}' requires an integer value".format(option), value)
+
+def _floatOption(config, option, default):
+    """
+    Retrieves a numerical value from the configuration, aborting if it
+    cannot be parsed.
+    """
+    value = config.get(option, default)
+
+    try:
+        return float(value)
+    except ValueError:
+        client.util.fatalError("option '{}' requires a numerical value".format(option), value)
+
 def createParser(config):
     """
     Creates the top-level command line argument parser. This parser is barely
@@ -434,6 +517,17 @@ def createParser(config):
     ssl_ca_cert = config.get("ssl-ca-cert", None)
     ssl_no_verify_hostname = config.get("ssl-no-verify-hostname", bool(socket))
     ssl_no_verify_certificate = config.get("ssl-no-verify-certificate", bool(socket))
+    meta_workers = _intOption(config, "meta-workers", _DefaultMetaWorkers)
+    meta_cache_ttl = _intOption(config, "meta-cache-ttl", 0)
+    connect_timeout = _floatOption(config, "connect-timeout", _DefaultConnectTimeout)
+    read_timeout = _floatOption(config, "read-timeout", _DefaultReadTimeout)
+    timeout = _floatOption(config, "timeout", 0)
+    retries = _intOption(config, "retries", _DefaultRetries)
+    checksum = config.get("checksum", None)
+
+    agent = config.get("agent", False)
+    if agent in _false_equivalent_strings:
+        agent = False
 
     parser = ComponentArgumentParser()
     parser.add_argument("--noblock", action="store_true", dest="noblock", default=noblock,
@@ -470,8 +564,32 @@ def createParser(config):
                     help="Unix domain socket to use for sending requests.")
     parser.add_argument("--cache", action="store", dest="cache", default=None,
                         help="Location where to store meta cache.")
+    parser.add_argument("--meta-workers", action="store", dest="meta_workers", type=int, default=meta_workers,
+                        help="Number of concurrent requests when downloading meta data.")
+    parser.add_argument("--meta-cache-ttl", action="store", dest="meta_cache_ttl", type=int, default=meta_cache_ttl,
+                        help="Seconds to use cached meta data without checking with the device.")
+    parser.add_argument("--connect-timeout", action="store", dest="connect_timeout", type=float, default=connect_timeout,
+                        help="Seconds to wait for a connection to the device. Zero means waiting indefinitely.")
+    parser.add_argument("--read-timeout", action="store", dest="read_timeout", type=float, default=read_timeout,
+                        help="Seconds to wait for the device to send data. Zero means waiting indefinitely.")
+    parser.add_argument("--timeout", action="store", dest="timeout", type=float, default=timeout,
+                        help="Seconds after which to give up on the command overall. Zero means no limit.")
+    parser.add_argument("--retries", action="store", dest="retries", type=int, default=retries,
+                        help="Number of times to retry failed requests that are safe to repeat.")
+    parser.add_argument("--checksum", action="store", dest="checksum", default=checksum, choices=_ChecksumAlgorithms,
+                        help="Print a checksum of each file saved, computed with the given algorithm.")
     parser.add_argument("--ignore-meta", action="store_true", dest="ignore_meta", default=False,
                         help="Do not send metadata info to sensor API call, unless it's specified on CLI.")
+    parser.add_argument("--batch", action="store", dest="batch", default=None, metavar="<file|->",
+                        help="Run the commands listed in a file, or on standard input, reporting their results as JSON lines.")
+    parser.add_argument("--batch-concurrency", action="store", dest="batch_concurrency", type=int, default=1,
+                        help="Maximum number of commands to run concurrently with --batch.")
+    parser.add_argument("--shell", action="store_true", dest="shell", default=False,
+                        help="Run commands entered interactively, keeping the connection and meta data between them.")
+    parser.add_argument("--agent", action="store_true", dest="agent", default=bool(agent),
+                        help="Run commands through a background agent that keeps connections and meta data warm between invocations.")
+    parser.add_argument("--no-agent", action="store_false", dest="agent",
+                        help="Run the command without the background agent.")
 
     # Legacy BroBox support. To be removed.
     parser.add_argument("--brobox", action="store", dest="brobox", default=None,
@@ -481,35 +599,329 @@ def createParser(config):
 
 ComponentParsers = {}
 
-def populateParser(parser, meta, limit_components_to=None):
+# Command tables loaded within this process, indexed by path.
+_CommandTables = {}
+
+class CommandTable:
+    """
+    A precompiled index of the commands provided by a set of meta data,
+    mapping each command's path to the URL and position of the resource
+    implementing it. The table is derived from the meta data once per cache
+    ID, so that later invocations can resolve the command to run without
+    going through the complete meta data.
+
+    The index is a trie of nested dictionaries keyed by the words of the
+    command paths. A node's entry under the empty key is the ``[url,
+    index]`` of the command ending there, if any.
+    """
+    def __init__(self, cache):
+        """Constructor.
+
+        cache (string): The cache ID of the meta data the table is
+        derived from.
+        """
+        self._cache = cache
+        self._trie = {}
+
+    def cacheID(self):
+        """Returns the cache ID of the meta data the table is derived from."""
+        return self._cache
+
+    @classmethod
+    def build(cls, meta):
+        """
+        Creates a new table from a set of meta data.
+
+        meta (meta.Meta): The meta data to index.
+
+        Returns: A new ``CommandTable``.
+        """
+        table = CommandTable(meta.cacheID())
+
+        for (url, resources) in meta:
+            for (index, r) in enumerate(resources):
+                node = table._trie
+
+                for word in r["component"] + [r["command"]]:
+                    node = node.setdefault(word, {})
+
+                node[""] = [url, index]
+
+        return table
+
+    @classmethod
+    def load(cls, path, cache):
+        """
+        Instantiates a table from a previously saved file.
+
+        path (str): The full path where to load the table from.
+
+        cache (string): The cache ID of the meta data the table must
+        correspond to.
+
+        Returns: A new ``CommandTable``, or None if the file did not exist,
+        could not be read, or was derived from different meta data.
+        """
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+
+            if data["cache-id"] != cache:
+                return None
+
+            table = CommandTable(cache)
+            table._trie = data["trie"]
+            return table
+
+        except:
+            # We just ignore any errors.
+            return None
+
+    def save(self, path):
+        """
+        Saves the table to disk.
+
+        path (str): The full path where to save the table.
+        """
+        data = json.dumps({"cache-id": self._cache, "trie": self._trie}, separators=(",", ":"))
+        client.util.writeFile(path, data.encode("utf8"))
+
+    def resolve(self, argv):
+        """
+        Determines the commands that a list of command line arguments
+        selects, by walking the arguments' leading words down the trie as
+        far as they match.
+
+        argv (list of str): The arguments remaining after removing the
+        global options.
+
+        Returns: A list of 2-tuples ``(str, int)`` with the URL and the
+        index of each selected command's resource within the URL's meta
+        data. If the words spell out a complete command, that's the only
+        one returned. If they stop at a component, that's all commands
+        below it; and if they don't match anything, that's all commands.
+        """
+        node = self._trie
+
+        for arg in argv:
+            if arg.startswith("-") or arg not in node:
+                break
+
+            node = node[arg]
+
+            if "" in node:
+                return [tuple(node[""])]
+
+        return list(_trieEntries(node))
+
+    def resolves(self, word):
+        """Returns True if a word is the start of any command's path."""
+        return word in self._trie
+
+    def complete(self, argv):
+        """
+        Determines the words that may follow a partial command path.
+
+        argv (list of str): The complete words of the command path so
+        far.
+
+        Returns: A sorted list of the words that continue the path, which
+        is empty if *argv* is a complete command or doesn't match any.
+        """
+        node = self._trie
+
+        for arg in argv:
+            if arg not in node:
+                return []
+
+            node = node[arg]
+
+        return sorted(word for word in node if word)
+
+def _trieEntries(node):
+    for (word, child) in sorted(node.items()):
+        if word:
+            for entry in _trieEntries(child):
+                yield entry
+        else:
+            yield tuple(child)
+
+def loadCommandTable(meta, path):
+    """
+    Returns the command table for a set of meta data, reusing a saved
+    table if it matches the meta data's cache ID, and building and saving
+    a new one otherwise.
+
+    meta (meta.Meta): The meta data to index.
+
+    path (str): The full path where the table is saved.
+
+    Returns: A ``CommandTable``.
+    """
+    table = _CommandTables.get(path, None)
+
+    if table and table.cacheID() == meta.cacheID():
+        return table
+
+    table = CommandTable.load(path, meta.cacheID())
+
+    if not table:
+        table = CommandTable.build(meta)
+        table.save(path)
+
+    _CommandTables[path] = table
+    return table
+
+def completions(meta, table, words, builtins=None):
+    """
+    Determines the possible completions for the next word of a command
+    line, as derived from the meta information: the components and
+    commands that may continue the command's path, or the options of the
+    command once its path is complete.
+
+    meta (meta.Meta): The complete meta information downloaded from a Corelight Sensor.
+
+    table (CommandTable): The command table for *meta*.
+
+    words (list of str): The complete words preceding the one to
+    complete, excluding any global options.
+
+    builtins (list of dict): Resources for commands that the client
+    implements itself, in the same format as the meta information's.
+
+    Returns: A sorted list of candidate words.
+    """
+    path = []
+
+    for word in words:
+        if word.startswith("-"):
+            break
+
+        path.append(word)
+
+    candidates = set(table.complete(path))
+    resources = []
+
+    if path and not candidates:
+        for (url, index) in table.resolve(path):
+            r = meta.get(url)
+
+            if r and index < len(r) and r[index]["component"] + [r[index]["command"]] == path:
+                resources.append(r[index])
+
+    for r in (builtins or []):
+        full = r["component"] + [r["command"]]
+
+        if full[:len(path)] == path and len(full) > len(path):
+            candidates.add(full[len(path)])
+        elif full == path and not resources:
+            resources.append(r)
+
+    for r in resources:
+        # Take the options from a parser for the command, so that they
+        # match what the command accepts.
+        command_parser = CommandArgumentParser()
+        _addCommandOptions(command_parser, r)
+
+        for action in command_parser._actions:
+            if action.help != argparse.SUPPRESS and action.dest != "help":
+                candidates.update(action.option_strings)
+
+    if not path:
+        candidates.add("help")
+
+    return sorted(candidates)
+
+def populateParser(parser, meta, limit_components_to=None, table=None, builtins=None):
     """
     Extend a previously created top-level command line argument parser with
     options derived from the meta information downloaded from a Corelight Sensor. This
     fills in most of the command & options that the command client supports.
 
+    Parsers are built only for what the command line selects: just the
+    command itself if it's given in full, the commands of a component if
+    the command line stops there (e.g., for ``help``), and all commands
+    otherwise.
+
     parser (ComponentArgumentParser): The parser to extend, which must have
     been previously created with ``createtopLevelParser()``.
 
     meta (meta.Meta): The complete meta information downloaded from a Corelight Sensor.
 
+    limit_components_to (list of str): The command line arguments
+    remaining after parsing the global options.
+
+    table (CommandTable): The command table for *meta*. If not given, one
+    is built on the fly.
+
+    builtins (list of dict): Resources for commands that the client
+    implements itself, in the same format as the meta information's.
+
     Returns: Nothing.
     """
+    # Parsers from an earlier invocation within the same process belong to
+    # a different top-level parser.
+    ComponentParsers.clear()
+
+    if not table:
+        table = CommandTable.build(meta)
+
     commands = []
 
-    for (_, resources) in meta:
-        for r in resources:
-            components = r["component"]
-            command = r["command"]
-            if not limit_components_to or components[0] in limit_components_to:
-                commands += [(components, command, r)]
+    for (url, index) in table.resolve(limit_components_to or []):
+        resources = meta.get(url)
+
+        if resources and index < len(resources):
+            r = resources[index]
+            commands += [(r["component"], r["command"], r)]
+
+    # Built-in commands go along with everything unless the command line
+    # selects a device component. The device's own commands take
+    # precedence.
+    words = limit_components_to or []
+    selected = (words[0] if words and not words[0].startswith("-") else None)
+    paths = set((tuple(c[0]), c[1]) for c in commands)
 
-    for (components, command, r) in sorted(commands):
+    for r in (builtins or []):
+        if (tuple(r["component"]), r["command"]) in paths:
+            continue
+
+        if not selected or selected == r["component"][0] or not table.resolves(selected):
+            commands += [(r["component"], r["command"], r)]
+
+    for (components, command, r) in sorted(commands, key=lambda c: (c[0], c[1])):
         component_parser = addComponentParser(parser, "", components)
         addCommandParser(component_parser, command, r)
 
     help = parser.componentParsers().add_parser("help")
     help.set_defaults(parser_for_help=parser)
 
+def _addCommandOptions(command_parser, resource):
+    """
+    Associates a command's parser with its resource, and adds the
+    options for the resource's parameters, fields, and variables.
+
+    command_parser (CommandArgumentParser): The parser to extend.
+
+    resource (dict): The meta information for the command's resource.
+    """
+    command_parser.setResource(resource)
+
+    for p in resource.get("parameters", []):
+        _buildArgument(command_parser, p)
+
+
+    for f in resource.get("request-fields", []):
+        command_parser.addRequestField(f)
+
+    for f in resource.get("response-fields", []):
+        command_parser.addResponseField(f)
+
+    for v in resource.get("variables", []):
+        _buildArgument(command_parser, v)
+
+    command_parser.finalizeResource()
+
 def addComponentParser(current_parser, current_path, components):
     if not components:
         return current_parser
@@ -545,23 +957,8 @@ def addCommandParser(component_parser, command, resource):
 
     command_parser = command_parsers.add_parser(command, help=_display(summary), dest=command)
     command_parser.setParent(component_parser)
-    command_parser.setResource(resource)
     command_parser.set_defaults(resource=resource)
-
-    for p in resource.get("parameters", []):
-        _buildArgument(command_parser, p)
-
-
-    for f in resource.get("request-fields", []):
-        command_parser.addRequestField(f)
-
-    for f in resource.get("response-fields", []):
-        command_parser.addResponseField(f)
-
-    for v in resource.get("variables", []):
-        _buildArgument(command_parser, v)
-
-    command_parser.finalizeResource()
+    _addCommandOptions(command_parser, resource)
 
     if command:
         command_parser.setPath(component_parser.path() + " " + command)
@@ -0,0 +1,283 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# Runs a batch of commands within a single process, sharing one session and
+# one set of meta data between them.
+#
+# A batch is read line by line. Each line specifies one command, either as
+# the command line arguments to run it with, split like a shell would, or
+# as JSON: a list of arguments, or an object with keys "argv" (a list of
+# arguments or a string), and optionally "id" (any value identifying the
+# command in its result) and "stdin" (the input for --read-stdin, a string
+# or any JSON value). Empty lines and lines starting with '#' are skipped.
+#
+# For each command, one JSON result is written to standard output as a
+# single line, carrying the command's ID, arguments, exit status, run time,
+# and the output it produced. Commands may run concurrently, in which case
+# results come in the order that the commands finish.
+
+import concurrent.futures
+import io
+import json
+import shlex
+import sys
+import threading
+import time
+
+import client.util
+
+def run(source, parse, execute, concurrency=1):
+    """
+    Runs a batch of commands.
+
+    source (str): The file to read the batch from, or ``-`` for standard
+    input.
+
+    parse (callable): Function receiving a command's list of arguments,
+    returning an object that represents the parsed command. Always called
+    from the main thread, one command at a time. Errors terminate the
+    function through ``SystemExit``.
+
+    execute (callable): Function receiving an object returned by *parse*
+    and running the command. May be called from multiple threads
+    concurrently. Errors terminate the function through ``SystemExit``.
+
+    concurrency (int): The maximum number of commands to run concurrently.
+
+    Returns: The batch's exit code: 0 if all commands succeeded, and 1
+    otherwise.
+    """
+    if concurrency < 1:
+        client.util.fatalError("batch concurrency must be positive")
+
+    try:
+        fp = (sys.stdin if source == "-" else open(source, "r"))
+    except IOError as e:
+        client.util.fatalError("cannot open batch file", e)
+
+    streams = _ThreadStreams()
+    failed = False
+
+    with streams, concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+
+        for (lineno, line) in enumerate(fp, 1):
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            command = _Command(lineno, line)
+
+            if not command.status:
+                command.parsed = command.call(streams, parse, command.argv)
+
+            if command.status or command.parsed is None:
+                # Failed, or done already (e.g., --help).
+                failed = _emit(streams, command) or failed
+                continue
+
+            pending.add(executor.submit(_execute, streams, execute, command))
+
+            if len(pending) >= concurrency:
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    failed = _emit(streams, future.result()) or failed
+
+        for future in concurrent.futures.as_completed(pending):
+            failed = _emit(streams, future.result()) or failed
+
+    if fp is not sys.stdin:
+        fp.close()
+
+    return (1 if failed else 0)
+
+def _execute(streams, execute, command):
+    command.call(streams, execute, command.parsed)
+    return command
+
+def _emit(streams, command):
+    """Writes a command's result. Returns True if the command failed."""
+    streams.write(json.dumps(command.result()) + "\n")
+    streams.flush()
+    return command.status != 0
+
+class _Command:
+    """A command from a batch, along with its outcome once run."""
+    def __init__(self, lineno, line):
+        """
+        Constructor. If the line cannot be parsed, ``status`` is set
+        accordingly, with ``stderr`` describing the problem.
+
+        lineno (int): The command's line number within the batch.
+
+        line (str): The command's line, without surrounding whitespace.
+        """
+        self.id = lineno
+        self.argv = []
+        self.stdin = None
+        self.parsed = None
+        self.status = 0
+        self.time = 0
+        self.stdout = ""
+        self.stderr = ""
+
+        try:
+            if line.startswith("{") or line.startswith("["):
+                spec = json.loads(line)
+
+                if isinstance(spec, dict):
+                    self.id = spec.get("id", self.id)
+                    self.stdin = spec.get("stdin", None)
+                    spec = spec.get("argv", [])
+
+                if isinstance(self.stdin, (dict, list)):
+                    self.stdin = json.dumps(self.stdin)
+
+            else:
+                spec = line
+
+            if isinstance(spec, str):
+                spec = shlex.split(spec)
+
+            if not isinstance(spec, list) or not all(isinstance(a, str) for a in spec):
+                raise ValueError("arguments must be a list of strings")
+
+            self.argv = spec
+
+        except ValueError as e:
+            self.status = 2
+            self.stderr = "Cannot parse command: {}\n".format(e)
+
+    def call(self, streams, func, arg):
+        """
+        Calls a function on behalf of the command, capturing its output
+        and accounting for its run time. If the function exits, records
+        the exit code as the command's status.
+
+        Returns: The function's result, or None if it exited.
+        """
+        start = time.time()
+        result = None
+
+        with streams.capture(self.stdin) as (stdout, stderr):
+            try:
+                result = func(arg)
+
+            except SystemExit as e:
+                self.status = e.code
+
+                if self.status is not None and not isinstance(self.status, int):
+                    # Same as the interpreter does for a non-integer exit status.
+                    print(self.status, file=sys.stderr)
+                    self.status = 1
+
+                self.status = (self.status or 0)
+
+            except Exception as e:
+                print("Error: {}".format(e), file=sys.stderr)
+                self.status = 1
+
+        self.time += time.time() - start
+        self.stdout += stdout.getvalue()
+        self.stderr += stderr.getvalue()
+        return result
+
+    def result(self):
+        """Returns the command's result for reporting as JSON."""
+        result = {
+            "id": self.id,
+            "argv": self.argv,
+            "status": self.status,
+            "time": round(self.time, 3),
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            }
+
+        try:
+            # Include the data if the command output JSON.
+            result["result"] = json.loads(self.stdout)
+        except ValueError:
+            pass
+
+        return result
+
+class _ThreadStreams:
+    """
+    Replaces the standard streams with ones that redirect each thread's
+    standard output and error to buffers of its own while capturing, and
+    pass everything else through to the original streams.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._saved = None
+
+    def __enter__(self):
+        self._saved = (sys.stdin, sys.stdout, sys.stderr)
+        (sys.stdin, sys.stdout, sys.stderr) = (_ThreadStream(self, 0), _ThreadStream(self, 1), _ThreadStream(self, 2))
+        return self
+
+    def __exit__(self, *exc):
+        (sys.stdin, sys.stdout, sys.stderr) = self._saved
+
+    def capture(self, stdin=None):
+        """
+        Returns a context manager capturing the current thread's output.
+        Within it, standard input provides *stdin*, or nothing if None.
+        The manager yields the buffers for standard output and error.
+        """
+        return _Capture(self._local, stdin)
+
+    def stream(self, index):
+        """Returns the stream currently in effect for the current thread."""
+        streams = getattr(self._local, "streams", None)
+        return (streams or self._saved)[index]
+
+    def write(self, data):
+        """Writes to the original standard output."""
+        self._saved[1].write(data)
+
+    def flush(self):
+        """Flushes the original standard output."""
+        self._saved[1].flush()
+
+class _Capture:
+    def __init__(self, local, stdin):
+        self._local = local
+        self._streams = (io.StringIO(stdin or ""), io.StringIO(), io.StringIO())
+
+    def __enter__(self):
+        self._local.streams = self._streams
+        return self._streams[1:]
+
+    def __exit__(self, *exc):
+        self._local.streams = None
+
+class _ThreadStream(io.TextIOBase):
+    """A standard stream forwarding to whatever is in effect for the current thread."""
+    def __init__(self, streams, index):
+        self._streams = streams
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(self._streams.stream(self._index), name)
+
+    def read(self, size=-1):
+        return self._streams.stream(self._index).read(size)
+
+    def readline(self, size=-1):
+        return self._streams.stream(self._index).readline(size)
+
+    def write(self, data):
+        return self._streams.stream(self._index).write(data)
+
+    def flush(self):
+        return self._streams.stream(self._index).flush()
+
+    def isatty(self):
+        return self._streams.stream(self._index).isatty()
+
+    def fileno(self):
+        return self._streams.stream(self._index).fileno()
@@ -0,0 +1,529 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+
+import copy
+import os
+import os.path
+import sys
+import re
+import urllib.parse
+
+import client.argparser
+import client.batch
+import client.configuration
+import client.jobs
+import client.meta
+import client.resource
+import client.session
+import client.shell
+import client.util
+
+from client.configuration import ConfigFileGlobal, ConfigFile, ConfigFileLegacy, StateDir, StateDirLegacy
+
+# URL to connect to.
+SensorBaseURL = "{scheme}://{netloc}/api/"
+FleetBaseURL = "{scheme}://{netloc}/fleet/v1/"
+
+# File where to store credentials if requested.
+CredentialsFile = os.path.join(StateDir, "credentials")
+
+# Legacy file where to store credentials if requested.
+CredentialsFileLegacy = os.path.join(StateDirLegacy, "credentials")
+
+# Base bath where to cache meta information.
+MetaCacheFileBase = os.path.join(StateDir, "cache")
+
+# Directory where to store meta information shared between devices.
+MetaStoreDir = os.path.join(StateDir, "meta")
+
+# Sessions kept open for reuse by later invocations within the same
+# process, indexed by device and connection options.
+_Sessions = {}
+
+def baseURL(device=None, fleet=None, uid=None):
+    """
+    Determines the base URL of the API to talk to, given either a Corelight
+    Sensor's address, or a Fleet Manager's address and optionally the UID
+    of a sensor managed by it.
+
+    device (str): The network address of a Corelight Sensor, optionally as
+    a URL.
+
+    fleet (str): The network address of a Corelight Fleet Manager,
+    optionally as a URL.
+
+    uid (str): The UID of a sensor managed by *fleet*, or None to talk to
+    the Fleet Manager itself.
+
+    Returns: A 3-tuple ``(str, str, str)`` with the base URL, its scheme,
+    and the Fleet Manager's base URL for authentication, or None if not
+    using a Fleet Manager. Raises ``ValueError`` if *uid* is invalid.
+    """
+    auth_base_url = None
+
+    if fleet:
+        if "://" in fleet:
+            base = urllib.parse.urlparse(fleet)
+            scheme = base.scheme
+            url = FleetBaseURL.format(scheme=base.scheme, netloc=base.netloc)
+        else:
+            scheme = "https"
+            url = FleetBaseURL.format(scheme="https", netloc=fleet)
+
+        auth_base_url = url
+
+        if uid:
+            if not re.search("^[0-9a-zA-Z-_]+$", uid):
+                raise ValueError("The sensor uid '{}' is invalid".format(uid))
+
+            url = client.util.appendUrl(url, "/sensor/instance/{}/api".format(uid))
+    else:
+        if "://" in device:
+            base = urllib.parse.urlparse(device)
+            scheme = base.scheme
+            url = SensorBaseURL.format(scheme=base.scheme, netloc=base.netloc)
+        else:
+            scheme = "https"
+            url = SensorBaseURL.format(scheme="https", netloc=device)
+
+    return (url, scheme, auth_base_url)
+
+def deviceID(url):
+    """
+    Returns a normalized version of a URL that we can use as a unique
+    index for the device, such as for naming files.
+    """
+    device_id = url.replace("://", "_").replace("/", "_").replace(":", "_").lower()
+
+    if device_id.endswith("_"):
+        device_id = device_id[:-1]
+
+    return device_id
+
+def _session(url, args):
+    """
+    Returns a session for talking to a device, reusing one from an
+    earlier invocation within the same process if the connection options
+    match, so that its connections remain warm.
+
+    url (str): The base URL of the device's API.
+
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns: A ``client.session.Session``.
+    """
+    key = (url, args.socket, args.ssl_ca_cert, args.ssl_no_verify_hostname, args.ssl_no_verify_certificate, args.batch_concurrency)
+    session = _Sessions.get(key, None)
+
+    if session:
+        client.util.debug("Reusing session for {}".format(url), level=2)
+        session.setArguments(args)
+    else:
+        session = client.session.Session(args)
+        _Sessions[key] = session
+
+    return session
+
+def main(argv=None):
+    """
+    Runs the command line client.
+
+    argv (list of str): The command line arguments, excluding the program
+    name. Defaults to ``sys.argv[1:]``.
+
+    Returns: The exit code. Errors may also terminate through
+    ``SystemExit``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Create a copy of the arguments that excludes any potential --help argument.
+    argv_pass1 = [a for a in argv if a != "-h" and a != "--help"]
+    argv_pass2 = list(argv)
+
+    corelight_device = os.environ.get("CORELIGHT_DEVICE", None)
+
+    # Legacy BroBox support. To be removed.
+    if "BROBOX" in os.environ and corelight_device is None:
+        print("""Note: The environment variable BROBOX has been renamed to CORELIGHT_DEVICE.
+      The old name is deprecated and support will be removed in a future version.
+""", file=sys.stderr)
+        corelight_device = os.environ.get("BROBOX", None)
+
+    config = {
+        "device": corelight_device
+    }
+
+    # Legacy BroBox support. To be removed.
+    if os.path.exists(ConfigFileLegacy):
+        print("""Note: Please rename {} to {}.
+      The old name is deprecated and support will be removed in a future version.
+""".format(ConfigFileLegacy, ConfigFile),
+          file=sys.stderr)
+        client.configuration.read(ConfigFileLegacy, config)
+
+    client.configuration.read(ConfigFileGlobal, config)
+    client.configuration.read(ConfigFile, config)
+
+    # Build initial bare-bones argument parser without any Corelight Sensor meta information.
+    parser = client.argparser.createParser(config)
+    (args, remaining) = parser.parse_known_args(argv_pass1)
+
+    # Legacy BroBox support. To be removed.
+    if not args.device and args.brobox:
+        print("""Note: Please use --device instead of --brobox.
+      The old option is deprecated and support will be removed in a future version.
+""", file=sys.stderr)
+        args.device = args.brobox
+
+    if args.version:
+        print("{} {}".format(client.NAME, client.VERSION))
+        sys.exit(0)
+
+    if (not args.device and not args.fleet) or (args.device and args.fleet):
+        if "-h" in argv or "--help" in argv or "help" in argv:
+            parser.print_help()
+        else:
+            print("You need to specify the address of either your Corelight Sensor or your Corelight Fleet Manager.")
+
+        sys.exit(1)
+
+    client.util.enableDebug(args.debug_level)
+
+    try:
+        (url, scheme, fleet_auth_base_url) = baseURL(args.device, args.fleet, args.uid)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    # Start connecting to the device while we prepare everything else.
+    args.auth_base_url = fleet_auth_base_url
+    session = _session(url, args)
+    session.setTimeout(args.timeout)
+    session.prewarm(url)
+
+    device_id = deviceID(url)
+
+    if args.fleet:
+        credentials_id = deviceID(fleet_auth_base_url)
+    else:
+        credentials_id = device_id
+
+    # Load the user credentials
+    credentials_updated = False
+    bearer_token_is_explicit = args.bearer_token
+    username_is_explicit = args.user
+    password_is_explicit = args.password
+    # We can use interactive password prompts, if all of the below are true:
+    #   * The user is not using a local/unsecured channel to connect (unless they told us to use a username, indicating they want password-based auth)
+    #   * The user is on an interactive console
+    #   * They didn't request --noblock (non-interactive mode)
+    #   * They didn't explicitly provide a bearer auth token
+    #   * They didn't explicitly provide a username AND a password (we can prompt for one or the other)
+    can_use_password_interactive = (scheme == "https" and not args.socket) or args.user
+    can_use_password_interactive = (can_use_password_interactive and sys.stdin.isatty() and sys.stdout.isatty())
+    can_use_password_interactive = (can_use_password_interactive and not args.noblock)
+    can_use_password_interactive = (can_use_password_interactive and not bearer_token_is_explicit)
+    can_use_password_interactive = (can_use_password_interactive and (not username_is_explicit or not password_is_explicit))
+
+    # Legacy BroBox support. To be removed.
+    if os.path.exists(CredentialsFileLegacy) and not os.path.exists(CredentialsFile):
+        print("""Note: The credentials file {} is deprecated and support will be
+      removed in a future version.  Please use {} instead."""
+            .format(CredentialsFileLegacy, CredentialsFile), file=sys.stderr)
+        # Legacy format that doesn't index by device.
+        d = {}
+        client.configuration.read(CredentialsFileLegacy, d)
+        cached_creds = (d.get("user", None), d.get("password", None), None)
+
+    else:
+        # New format indexed by device ID.
+        cached_creds = client.configuration.readCredentials(CredentialsFile, credentials_id)
+
+    cached_credential_argv = []
+
+    if cached_creds[client.configuration.CRED_USER_OFFSET] and not args.user:
+        args.user = cached_creds[client.configuration.CRED_USER_OFFSET]
+        cached_credential_argv = ["--user", args.user] + cached_credential_argv
+
+    if cached_creds[client.configuration.CRED_PASS_OFFSET] and not args.password:
+        args.password = cached_creds[client.configuration.CRED_PASS_OFFSET]
+        cached_credential_argv = ["--password", args.password] + cached_credential_argv
+
+    if cached_creds[client.configuration.CRED_BEARER_OFFSET] and not args.bearer_token:
+        args.bearer_token = cached_creds[client.configuration.CRED_BEARER_OFFSET]
+        cached_credential_argv = ["--bearer", args.bearer_token] + cached_credential_argv
+
+    # Create directory for persistent state.
+    if not os.path.isdir(StateDir):
+        try:
+            os.makedirs(StateDir, mode=0o700, exist_ok=True)
+        except IOError as e:
+            client.util.fatalError("cannot create directory '{}'".format(StateDir), e)
+
+    # Determine the authentication methods we should use
+    AUTH_TYPE_BEARER_TOKEN = "Bearer Token"
+    AUTH_TYPE_PASSWORD = "Password"
+    AUTH_TYPE_PASSWORD_INTERACTIVE = "Password Interactive"
+    AUTH_TYPE_NONE = "None"
+
+    # Order the schemes we will use
+    auth_schemes_to_use = []
+
+    # 1. Explicit bearer tokens
+    if bearer_token_is_explicit:
+        auth_schemes_to_use += [AUTH_TYPE_BEARER_TOKEN]
+    # 2. explicit passwords
+    elif password_is_explicit and username_is_explicit:
+        auth_schemes_to_use += [AUTH_TYPE_PASSWORD]
+    else:
+        # 3. Cached bearer tokens as long as a user isn't specified or the user matches the cached token
+        if args.bearer_token and ((not args.user) or (cached_creds[client.configuration.CRED_USER_OFFSET] == args.user)):
+            auth_schemes_to_use += [AUTH_TYPE_BEARER_TOKEN]
+        # 4. Cached usernames and passwords.
+        if args.user and args.password and (cached_creds[client.configuration.CRED_USER_OFFSET] == args.user):
+            auth_schemes_to_use += [AUTH_TYPE_PASSWORD]
+        # 5. Password interactive (multiple tries)
+        if can_use_password_interactive:
+            auth_schemes_to_use += [AUTH_TYPE_PASSWORD_INTERACTIVE, AUTH_TYPE_PASSWORD_INTERACTIVE, AUTH_TYPE_PASSWORD_INTERACTIVE]
+
+    # 6. 'None' if nothing else
+    if len(auth_schemes_to_use) == 0:
+        auth_schemes_to_use += [AUTH_TYPE_NONE]
+
+    # Retrieve meta information from device.
+    if args.cache:
+        cache = args.cache
+        meta_store = None
+    else:
+        cache = (MetaCacheFileBase + "_" + device_id)
+        meta_store = MetaStoreDir
+
+    # Authenticate and load API metadata
+    new_credential_argv = []
+    auth_method_used = AUTH_TYPE_NONE
+
+    for i in range(len(auth_schemes_to_use)):
+        auth_method_used = auth_schemes_to_use[i]
+        has_next_auth_scheme = ((i + 1) < len(auth_schemes_to_use))
+        try:
+            msg = "Trying next authentication method ({})".format(auth_method_used)
+
+            if i == 0:
+                client.util.debug(msg)
+            else:
+                client.util.infoMessage(msg)
+
+            # If we are in password interactive mode, we need to
+            # prompt the user now.
+            if AUTH_TYPE_PASSWORD_INTERACTIVE == auth_method_used:
+                args.bearer_token = None
+                if not password_is_explicit:
+                    args.password = None
+
+                if not username_is_explicit:
+                    args.user = None
+
+                new_credential_argv = client.util.promptUserCredentials(args)
+            elif AUTH_TYPE_PASSWORD == auth_method_used:
+                args.bearer_token = None
+                new_credential_argv = ["--user", args.user, "--password", args.password]
+            elif AUTH_TYPE_NONE == auth_method_used:
+                args.bearer_token = None
+                args.user = None
+                args.password = None
+
+            # Fetch the metadata. Cached meta data within its TTL needs no
+            # request, which would leave credentials unchecked until the
+            # command runs. While there's another scheme to fall back to,
+            # always ask the device so that a 401 still leads to it.
+            ttl = (0 if has_next_auth_scheme else args.meta_cache_ttl)
+            meta = client.meta.load(session, url, cache_file=cache, workers=args.meta_workers, ttl=ttl, store=meta_store)
+
+            # If we use password auth, we may have retrieved a new bearer token.
+            if AUTH_TYPE_PASSWORD == auth_method_used or AUTH_TYPE_PASSWORD_INTERACTIVE == auth_method_used:
+                if args.bearer_token:
+                    new_credential_argv = new_credential_argv + [ "--bearer", args.bearer_token ]
+
+            # We succeeded at getting metadata. Save what we have to
+            msg = "Authentication succeeded ({})".format(auth_method_used)
+            if i == 0:
+                client.util.debug(msg)
+            else:
+                client.util.infoMessage(msg)
+
+            break
+
+        except client.session.SessionError as e:
+            if e.status_code == 401:
+                client.util.error("Authentication method failed", auth_method_used)
+
+            if e.status_code == 401 and has_next_auth_scheme:
+                # Clear out the invalid credentials for the next iteration
+                if AUTH_TYPE_BEARER_TOKEN == auth_method_used:
+                    args.bearer_token = None
+                elif AUTH_TYPE_PASSWORD == auth_method_used or AUTH_TYPE_PASSWORD_INTERACTIVE == auth_method_used:
+                    new_credential_argv = []
+                    if not username_is_explicit:
+                        args.user = None
+                    if not password_is_explicit:
+                        args.password = None
+            else:
+                e.fatalError()
+
+    if len(new_credential_argv) > 0:
+        argv_pass2 = new_credential_argv + argv_pass2
+    elif len(cached_credential_argv) > 0:
+        argv_pass2 = cached_credential_argv + argv_pass2
+
+    # Access worked, offer to save crendentials if entered interactively.
+    used_password_authentication =  (auth_method_used == AUTH_TYPE_PASSWORD_INTERACTIVE or auth_method_used == AUTH_TYPE_PASSWORD)
+
+    if not args.no_password_save:
+        save_credentials = False
+        include_password = False
+        # We can update the bearer token automatically if all of the following are true:
+        #  * We previously had a bearer token cached.
+        #  * We have a bearer token now.
+        #  * The cached bearer token does not match our current one (e.g. we have a new one).
+        #  * We used password authentication to get the new bearer token.
+        #  * The previous bearer token was cached for the same user as the new one.
+        automatically_cache_bearer_token = cached_creds[client.configuration.CRED_BEARER_OFFSET]
+        automatically_cache_bearer_token = (automatically_cache_bearer_token and args.bearer_token)
+        automatically_cache_bearer_token = (automatically_cache_bearer_token and cached_creds[client.configuration.CRED_BEARER_OFFSET] != args.bearer_token)
+        automatically_cache_bearer_token = (automatically_cache_bearer_token and used_password_authentication)
+        automatically_cache_bearer_token = (automatically_cache_bearer_token and args.user == cached_creds[client.configuration.CRED_USER_OFFSET])
+
+        if automatically_cache_bearer_token:
+            # Just update the bearer token and tell the user to expect this.
+            save_credentials = True
+            include_password = (cached_creds[client.configuration.CRED_USER_OFFSET] and cached_creds[client.configuration.CRED_PASS_OFFSET])
+            if include_password and cached_creds[client.configuration.CRED_PASS_OFFSET] != args.password:
+                print("Updating authenticated session and plain text password in '{}'".format(CredentialsFile), file=sys.stderr)
+            else:
+                print("Updating authenticated session in '{}'".format(CredentialsFile), file=sys.stderr)
+
+        elif auth_method_used == AUTH_TYPE_PASSWORD_INTERACTIVE and not args.noblock:
+            if args.bearer_token:
+                # We have an authenticated session. Try to get the user to not save their password.
+                save_credentials = (client.util.getInput("Cache authenticated session? Please note that your session token will be saved in plain text under '{}'. (yes/no)".format(CredentialsFile)) == "yes")
+                include_password = save_credentials and (client.util.getInput("Include password in plain text? After expiry, your authenticated session will have to be refreshed. (yes/no)") == "yes")
+            else:
+                # For systems (e.g. sensors) where we only have a password we will only ask one question.
+                save_credentials = (client.util.getInput("Save credentials? Please note that your username and password will be saved in plain text under '{}'. (yes/no)".format(CredentialsFile)) == "yes")
+                include_password = save_credentials
+
+        if save_credentials:
+            client.configuration.saveCredentials(CredentialsFile, args, credentials_id, include_password)
+
+    # Now extend the argument parser with all the meta information.
+    table = client.argparser.loadCommandTable(meta, cache + ".commands")
+
+    if args.batch or args.shell:
+        if remaining:
+            client.util.fatalError("--batch and --shell cannot be combined with a command")
+
+        args.auth_base_url = fleet_auth_base_url
+        session.setArguments(args)
+
+        def parse(command_argv):
+            # The global options given on the command line apply to all
+            # commands.
+            command_parser = client.argparser.createParser(config)
+            command_argv = argv_pass2 + command_argv
+            (command_args, command_remaining) = command_parser.parse_known_args([a for a in command_argv if a != "-h" and a != "--help"])
+
+            if any(getattr(command_args, k) != getattr(args, k) for k in ("device", "fleet", "uid", "socket")):
+                client.util.fatalError("commands cannot select a different device")
+
+            return _parseCommand(command_parser, meta, table, command_argv, command_remaining, fleet_auth_base_url)
+
+        def execute(command_args):
+            _runCommand(session.withArguments(command_args), meta, command_args)
+
+        if args.batch:
+            return client.batch.run(args.batch, parse, execute, args.batch_concurrency)
+
+        def complete(words):
+            return client.argparser.completions(meta, table, words, builtins=client.jobs.Commands)
+
+        prompt = "{}> ".format(args.uid or args.device or args.fleet)
+        return client.shell.run(prompt, parse, execute, complete)
+
+    args = _parseCommand(parser, meta, table, argv_pass2, remaining, fleet_auth_base_url)
+    session.setArguments(args)
+    _runCommand(session, meta, args)
+    return 0
+
+def _parseCommand(parser, meta, table, argv, remaining, auth_base_url):
+    """
+    Parses a command's arguments after extending the argument parser with
+    the commands that the arguments select.
+
+    parser (ComponentArgumentParser): The top-level argument parser.
+
+    meta (meta.Meta): The device's meta information.
+
+    table (CommandTable): The command table for *meta*.
+
+    argv (list of str): The command line arguments to parse.
+
+    remaining (list of str): The arguments remaining after parsing just
+    the global options.
+
+    auth_base_url (str): The base URL for authenticating with a Fleet
+    Manager, or None.
+
+    Returns: The ``argparse.Namespace`` with the parsed arguments.
+    """
+    client.argparser.populateParser(parser, meta, limit_components_to=remaining, table=table, builtins=client.jobs.Commands)
+
+    args = parser.parse_args(argv)
+    args.auth_base_url = auth_base_url
+
+    # Check if we should exclude the meta parameters
+    if args.ignore_meta and 'parameters' in args.resource:
+        # The resource belongs to meta data that later invocations within
+        # the same process may reuse, so work on a copy.
+        args.resource = copy.copy(args.resource)
+        args.resource['parameters'] = list(args.resource['parameters'])
+
+        # loop through args and exclude any that are not required, or not specified on CLI
+        # We start at the end of the list and move to the beginning
+        for i in range(len(args.resource['parameters']) - 1, -1, -1):
+            if 'required' in args.resource['parameters'][i] and 'type' in args.resource['parameters'][i]:
+                if args.resource['parameters'][i]['type'] == 'flag' and args.resource['parameters'][i]['required'] == False:
+                    if '--' + args.resource['parameters'][i]['name'] not in remaining:
+                        args.resource['parameters'].pop(i)
+
+    return args
+
+def _runCommand(session, meta, args):
+    """
+    Runs a parsed command.
+
+    session (client.session.Session): The session to use for requests,
+    associated with *args*.
+
+    meta (meta.Meta): The device's meta information.
+
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+    try:
+        # A "help" command.
+        help = args.parser_for_help
+        client.argparser.printHelp(None, help, args)
+    except AttributeError:
+        pass
+
+    try:
+        resource = args.resource
+    except AttributeError:
+        print("No command given. Use --help to see list.")
+        sys.exit(1)
+
+    if resource.get("builtin", None):
+        client.jobs.process(session, meta, resource)
+    else:
+        client.resource.process(session, resource)
@@ -12,6 +12,21 @@ CRED_USER_OFFSET = 0
 CRED_PASS_OFFSET = 1
 CRED_BEARER_OFFSET = 2
 
+# Global configuration file.
+ConfigFileGlobal = "/etc/corelight-client.rc"
+
+# User configuration file.
+ConfigFile = os.path.expanduser("~/.corelight-client.rc")
+
+# Legacy configuration file, to be removed.
+ConfigFileLegacy = os.path.expanduser("~/.broboxrc")
+
+# Directory where to store persistent state.
+StateDir = os.path.expanduser("~/.corelight-client")
+
+# Legacy directory where to store persistent state.
+StateDirLegacy = os.path.expanduser("~/.brobox")
+
 def read(path, config):
     """
     Read user configuration file.
@@ -38,7 +53,7 @@ def read(path, config):
             except ValueError:
                 client.util.fatalError("cannot parse line {} in configuration file".format(cnt), path)
 
-            for option in ("socket", "noblock", "device", "user", "password", "ssl-ca-cert", "ssl-no-verify-hostname", "ssl-no-verify-certificate", "brobox", "fleet", "uid", "mfa", "bearer-token", "no-password-save"):
+            for option in ("socket", "noblock", "device", "user", "password", "ssl-ca-cert", "ssl-no-verify-hostname", "ssl-no-verify-certificate", "brobox", "fleet", "uid", "mfa", "bearer-token", "no-password-save", "meta-workers", "meta-cache-ttl", "agent", "connect-timeout", "read-timeout", "timeout", "retries", "checksum"):
                 if k.lower() == option:
                     config[option] = v
                     # If another configuration file overrides our value
@@ -107,31 +122,28 @@ def saveCredentials(path, args, device_id, include_password=True):
     device_id (str): Unique ID for the device we are talking to.
     """
     try:
-        with open(path, "r") as fp:
-            data = json.load(fp)
-            fp.close()
-    except (IOError, ValueError):
-        # Ok if it doesn't exist yet, or we cannot parse it.
-        data = {}
+        with client.util.lockFile(path):
+            try:
+                with open(path, "r") as fp:
+                    data = json.load(fp)
+            except (IOError, ValueError):
+                # Ok if it doesn't exist yet, or we cannot parse it.
+                data = {}
 
-    new_creds = {}
-    if args.bearer_token:
-        new_creds["bearer-token"] = args.bearer_token
+            new_creds = {}
+            if args.bearer_token:
+                new_creds["bearer-token"] = args.bearer_token
 
-    if args.user:
-        new_creds["user"] = args.user
+            if args.user:
+                new_creds["user"] = args.user
 
-    if include_password and args.password:
-        new_creds["password"] = args.password
+            if include_password and args.password:
+                new_creds["password"] = args.password
 
-    data[device_id] = new_creds
+            data[device_id] = new_creds
 
-    try:
-        with open(path, "w") as fp:
-            json.dump(data, fp, indent=2)
-            fp.close()
+            client.util.writeFile(path, json.dumps(data, indent=2).encode("utf8"), mode=0o600)
 
-        os.chmod(path, 0o600)
         print("Credentials saved to {}".format(path))
 
     except IOError as e:
@@ -0,0 +1,289 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# A registry of asynchronous operations started with --async, along with
+# the client's built-in "jobs" commands for listing them and retrieving
+# their results later.
+#
+# Each job is saved as a JSON file in the state directory, recording the
+# device it runs on, the command that started it, the location where its
+# result becomes available, and when it was submitted. Jobs are scoped by
+# the device or Fleet Manager they were submitted to; through a Fleet
+# Manager, that covers all its sensors.
+
+import concurrent.futures
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+import uuid
+
+import client.resource
+import client.session
+import client.util
+
+from client.configuration import StateDir
+
+# Directory where to store job handles.
+JobsDir = os.path.join(StateDir, "jobs")
+
+# Seconds after which to forget about a job whose result we never retrieved.
+_MaxAge = 7 * 24 * 60 * 60
+
+# Default number of jobs to wait for concurrently.
+_DefaultConcurrency = 8
+
+# Default maximum number of requests per second when waiting for jobs.
+_DefaultRate = 10
+
+# The format for displaying submission times.
+_TimeFormat = "%Y-%m-%d %H:%M:%S"
+
+# Resources describing the built-in commands, in the format of the
+# device's meta data.
+Commands = [
+    {
+        "component": ["jobs"],
+        "command": "list",
+        "builtin": "jobs-list",
+        "summary": "List pending asynchronous operations",
+        "description": "Lists the asynchronous operations started without waiting for them to finish whose results have not been retrieved yet.",
+        "requires-confirmation": False,
+        "parameters": [],
+        "request-fields": [],
+        "response-fields": [],
+        "variables": [],
+    },
+    {
+        "component": ["jobs"],
+        "command": "wait",
+        "builtin": "jobs-wait",
+        "summary": "Wait for pending asynchronous operations and show their results",
+        "description": "Waits for asynchronous operations started without waiting for them to finish, checking on several of them concurrently, and shows their results as they become available.",
+        "requires-confirmation": False,
+        "parameters": [
+            {"name": "ids", "type": "string", "metavar": "id,...", "description": "Comma-separated IDs of the jobs to wait for. Defaults to all jobs."},
+            {"name": "concurrency", "type": "integer", "default": _DefaultConcurrency, "description": "Maximum number of jobs to check on concurrently."},
+            {"name": "rate", "type": "float", "default": _DefaultRate, "description": "Maximum number of requests per second to send while waiting."},
+        ],
+        "request-fields": [],
+        "response-fields": [],
+        "variables": [],
+    },
+]
+
+def _scope(args):
+    """Returns the device or Fleet Manager that jobs submitted with the given options belong to."""
+    return {"device": args.device, "fleet": args.fleet}
+
+def record(args, resource, location):
+    """
+    Saves a handle for an asynchronous operation that's been submitted.
+
+    args (argparse.Namespace): The parsed command line options the
+    operation was submitted with.
+
+    resource (dict): The meta information for the resource that started the
+    operation.
+
+    location (str): The URL where the operation's result becomes
+    available.
+
+    Returns: The ID of the new job.
+    """
+    job = dict(_scope(args))
+    job.update({
+        "id": uuid.uuid4().hex[:8],
+        "uid": args.uid,
+        "command": " ".join(resource["component"] + [resource["command"]]),
+        "resource": resource["resource"],
+        "location": location,
+        "submitted": time.time(),
+        })
+
+    try:
+        os.makedirs(JobsDir, mode=0o700, exist_ok=True)
+        client.util.writeFile(_path(job["id"]), json.dumps(job).encode("utf8"), mode=0o600)
+    except IOError as e:
+        client.util.fatalError("cannot save job", e)
+
+    return job["id"]
+
+def load(args):
+    """
+    Returns the jobs submitted to the device or Fleet Manager that the
+    given options select, ordered by submission time. Jobs older than
+    ``_MaxAge`` are removed.
+
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns: A list of dictionaries, one per job.
+    """
+    jobs = []
+    scope = _scope(args)
+
+    try:
+        names = os.listdir(JobsDir)
+    except FileNotFoundError:
+        return []
+
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+
+        try:
+            with open(os.path.join(JobsDir, name)) as fp:
+                job = json.load(fp)
+        except (IOError, ValueError):
+            continue
+
+        if time.time() - job.get("submitted", 0) > _MaxAge:
+            remove(job)
+            continue
+
+        if all(job.get(k, None) == v for (k, v) in scope.items()):
+            jobs.append(job)
+
+    return sorted(jobs, key=lambda job: job["submitted"])
+
+def remove(job):
+    """Removes a job from the registry."""
+    try:
+        os.unlink(_path(job["id"]))
+    except (FileNotFoundError, KeyError):
+        pass
+
+def _path(id):
+    return os.path.join(JobsDir, "{}.json".format(id))
+
+def process(session, meta, resource):
+    """
+    Runs one of the built-in ``jobs`` commands.
+
+    session (client.session.Session): The session object to use for
+    requests.
+
+    meta (meta.Meta): The device's meta information.
+
+    resource (dict): The entry from ``Commands`` for the command to run.
+
+    Returns: Nothing.
+    """
+    args = session.arguments()
+
+    if resource["builtin"] == "jobs-list":
+        _list(load(args))
+
+    elif resource["builtin"] == "jobs-wait":
+        jobs = load(args)
+
+        if args.ids:
+            ids = set(args.ids.split(","))
+            unknown = ids - set(job["id"] for job in jobs)
+
+            if unknown:
+                client.util.fatalError("unknown job", ", ".join(sorted(unknown)))
+
+            jobs = [job for job in jobs if job["id"] in ids]
+
+        if args.concurrency < 1 or args.rate <= 0:
+            client.util.fatalError("concurrency and rate must be positive")
+
+        _wait(session, meta, jobs, args.concurrency, args.rate)
+
+def _describe(job):
+    device = (job["device"] or job["fleet"])
+
+    if job.get("uid", None):
+        device += "/" + job["uid"]
+
+    return "{} on {}".format(job["command"], device)
+
+def _list(jobs):
+    if not jobs:
+        print("No entries.")
+        return
+
+    print()
+
+    for job in jobs:
+        submitted = time.strftime(_TimeFormat, time.localtime(job["submitted"]))
+        print(client.util.formatTuples([(job["id"], "{}, submitted {}".format(_describe(job), submitted))]), end="")
+
+    print()
+
+def _findResource(meta, job):
+    """Returns the meta information for the resource that started a job, or a stand-in if it's gone."""
+    for r in meta.get(job["resource"]) or []:
+        if " ".join(r["component"] + [r["command"]]) == job["command"]:
+            return r
+
+    return {"component": [], "command": job["command"], "response-fields": []}
+
+def _wait(session, meta, jobs, concurrency, rate):
+    """
+    Waits for a set of jobs concurrently, showing each one's result as it
+    becomes available. Exits with an error status if any of them failed.
+    """
+    if not jobs:
+        print("No entries.")
+        return
+
+    limiter = _RateLimiter(rate)
+    failed = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_poll, session, job, limiter): job for job in jobs}
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            print("== Job {}: {}".format(job["id"], _describe(job)))
+
+            try:
+                (response, schema, cache, data) = future.result()
+            except client.session.SessionError as e:
+                # Couldn't reach the device. Keep the job around so that
+                # we can try again later.
+                client.util.error(str(e))
+                failed = True
+                continue
+
+            remove(job)
+
+            try:
+                client.resource._processResponse(session, _findResource(meta, job), response, schema, cache, data)
+            except SystemExit as e:
+                # An error response, already reported.
+                failed = failed or bool(e.code)
+
+    if failed:
+        sys.exit(1)
+
+def _poll(session, job, limiter):
+    """Retrieves a job's result, waiting for it if necessary."""
+    return client.resource._waitForResult(session, None, location=job["location"], progress=False, throttle=limiter.wait)
+
+class _RateLimiter:
+    """Spaces out calls across threads to stay below a given rate."""
+    def __init__(self, rate):
+        """
+        Constructor.
+
+        rate (float): The maximum number of calls per second.
+        """
+        self._interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed."""
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+
+        if slot > now:
+            time.sleep(slot - now)
@@ -2,14 +2,38 @@
 #
 # See COPYING for license information.
 
+import concurrent.futures
+import contextlib
+import hashlib
 import json
-
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+
+import client.session
 import client.util
 
+# Magic bytes identifying the binary cache format.
+_CacheMagic = b"CLMETA\x01\n"
+
+# Struct for the length of the header following the magic bytes.
+_CacheHeader = struct.Struct(">I")
+
+# Meta data loaded or saved by this process, indexed by cache file. Each
+# entry is a tuple (file status, Meta) so that the meta data can be reused
+# as long as the file remains unchanged.
+_Loaded = {}
+
 class Meta:
     """
     A class storing a Corelight Sensor's meta information, mapping available URLs,
     to their corresponding API meta data.
+
+    When loaded from a cache, the meta data for a URL is decoded only once
+    it is accessed.
     """
     def __init__(self, cache):
         """Constructor.
@@ -20,6 +44,17 @@ class Meta:
         """
         self._cache = cache
         self._resources = {}
+        self._components = {}
+        self._records = {}
+        self._mmap = None
+        self._base_url = None
+        self._relative = False
+        self._store = None
+        self._key = None
+        self._validators = {}
+        self._index_validators = {}
+        self._validated = time.time()
+        self._dirty = True
         self.from_cache = False
 
     def cacheID(self):
@@ -36,107 +71,655 @@ class Meta:
 
         Returns: A dictionary with the meta data, nor None if the URL is not
         know."""
-        return self._resources.get(url)
+        meta = self._resources.get(url)
+
+        if meta is None and url in self._records:
+            (offset, length) = self._records[url]
+            meta = json.loads(zlib.decompress(self._mmap[offset:offset + length]).decode("utf8"))
+
+            if self._relative:
+                meta = _rebase(meta, self._base_url)
+
+            self._resources[url] = meta
+
+        return meta
+
+    def validator(self, url):
+        """
+        Retrieves the validator the server associated with a URL's meta data.
+
+        Returns: The ``ETag`` received with the meta data as a string, or
+        None if the URL is not known or the server did not send one.
+        """
+        return self._validators.get(url)
+
+    def age(self):
+        """
+        Returns the number of seconds since the meta data was last confirmed
+        to be current by the server.
+        """
+        return time.time() - self._validated
+
+    def indexValidators(self):
+        """
+        Returns a dictionary of conditional request headers for revalidating
+        the API index this meta data was derived from. The dictionary is
+        empty if the server did not provide any validators.
+        """
+        headers = {}
+
+        if "etag" in self._index_validators:
+            headers["If-None-Match"] = self._index_validators["etag"]
+
+        if "last-modified" in self._index_validators:
+            headers["If-Modified-Since"] = self._index_validators["last-modified"]
+
+        return headers
+
+    def setIndexValidators(self, response):
+        """
+        Records the validators the server sent with the API index.
 
-    def add(self, url, meta):
+        response (requests.Response): The response to the index request.
+        """
+        self._index_validators = {}
+
+        for (header, key) in (("ETag", "etag"), ("Last-Modified", "last-modified")):
+            value = response.headers.get(header, None)
+
+            if value:
+                self._index_validators[key] = value
+
+    def touch(self):
+        """
+        Records that the server has just confirmed the meta data to be
+        current.
+        """
+        self._validated = time.time()
+        self._dirty = True
+
+    def needsSave(self):
+        """
+        Returns True if the meta data has changed since it was loaded from,
+        or last saved to, the cache.
+        """
+        return self._dirty
+
+    def add(self, url, meta, validator=None):
         """
         Add a mapping of URL to meta information.
 
         url (string): The URL to index on.
 
         meta (dict): A dictionary with Corelight Sensor meta data for the URL
+
+        validator (str): The ``ETag`` the server sent along with the meta
+        data, if any. It allows to later revalidate the meta data through a
+        conditional request.
         """
         self._resources[url] = meta
+        self._components[url] = _topLevelComponents(meta)
+        self._records.pop(url, None)
+        self._dirty = True
+
+        if validator:
+            self._validators[url] = validator
+        else:
+            self._validators.pop(url, None)
+
+    def setStore(self, store, key, base_url):
+        """
+        Associates the meta data with a shared, content-addressed store.
+        Saving the meta data then places it into the store, with all URLs
+        relative to *base_url*, and leaves just a pointer in the cache file.
+        That allows other devices with the same API to reuse it.
+
+        store (str): The directory of the store.
+
+        key (str): The key identifying the meta data in the store, as
+        returned by ``storeKey()``.
+
+        base_url (string): The base URL of the API the meta data is for.
+        """
+        self._store = store
+        self._key = key
+        self._base_url = base_url
+
+    def select(self, components=None):
+        """
+        Iterates over the meta data for URLs providing commands of a given
+        set of top-level components, decoding only those.
+
+        components (list of str): The names of the top-level components to
+        include. If empty or None, all URLs are included.
+
+        Returns: An iterator over 2-tuples ``(url, meta)``.
+        """
+        for (url, names) in list(self._components.items()):
+            if not components or any(name in components for name in names):
+                yield (url, self.get(url))
 
     def save(self, path):
         """
         Save the cache content to disk.
 
+        The cache consists of a header indexing the URLs, followed by a
+        separately compressed record for each URL's meta data. URLs that
+        have not been accessed since loading the cache are copied over
+        without decoding them.
+
+        If the meta data is associated with a store, the content goes there
+        and *path* receives a pointer to it.
+
         path (str): The full path where to save the cache.
         """
-        cached_data = {
+        if self._store and self._key and self._isRelocatable():
+            obj = os.path.join(self._store, self._key)
+
+            if not os.path.exists(obj):
+                os.makedirs(self._store, mode=0o700, exist_ok=True)
+                self._writeCache(obj, True, {})
+                _pruneStore(self._store)
+
+            pointer = {
+                'object': obj,
+                'base-url': self._base_url,
+                'index-validators': self._index_validators,
+                'validated': self._validated,
+            }
+
+            client.util.writeFile(path, json.dumps(pointer, indent=2, sort_keys=True).encode("utf8"))
+
+        else:
+            self._writeCache(path, False, {
+                'index-validators': self._index_validators,
+                'validated': self._validated,
+            })
+
+        self._dirty = False
+
+    def _isRelocatable(self):
+        """
+        Returns True if all URLs are below the base URL, so that the meta
+        data can be stored independent of the device.
+        """
+        if self._relative:
+            return True
+
+        for (url, resources) in self:
+            if not url.startswith(self._base_url):
+                return False
+
+            for r in resources:
+                if not r.get("resource", "").startswith(self._base_url):
+                    return False
+
+        return True
+
+    def _writeCache(self, path, relative, header):
+        """
+        Writes the cache content in the indexed format.
+
+        relative (bool): True to write all URLs relative to the base URL.
+
+        header (dict): Additional entries for the header.
+        """
+        records = []
+        index = {}
+        offset = 0
+
+        for url in self._components:
+            key = (url[len(self._base_url):] if relative else url)
+
+            if url in self._records and self._relative == relative:
+                (start, length) = self._records[url]
+                record = self._mmap[start:start + length]
+            else:
+                meta = self.get(url)
+
+                if relative:
+                    meta = _relativize(meta, self._base_url)
+
+                data = json.dumps(meta, separators=(",", ":"), sort_keys=True)
+                record = zlib.compress(data.encode("utf8"))
+
+            index[key] = [offset, len(record), self._components[url]]
+            records.append(record)
+            offset += len(record)
+
+        validators = self._validators
+
+        if relative:
+            validators = { url[len(self._base_url):]: v for (url, v) in validators.items() }
+
+        header = dict(header)
+        header.update({
             'cache-id': self._cache,
-            'resources': self._resources,
-        }
-        with open(path, "w") as fp:
-            json.dump(cached_data, fp=fp, indent=2, sort_keys=True)
+            'index': index,
+            'validators': validators,
+            'relative': relative,
+        })
+
+        header = json.dumps(header, separators=(",", ":")).encode("utf8")
+        client.util.writeFile(path, b"".join([_CacheMagic, _CacheHeader.pack(len(header)), header] + records))
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, base_url=None):
         """
-        Instantiates a new Meta object from a previously saved cache.
+        Instantiates a new Meta object from a previously saved cache. The
+        cache's records are mapped into memory and decoded on first access.
+        Caches in the JSON format of earlier versions are read as well, and
+        flagged as needing to be saved in the current format. If the cache
+        is a pointer into a store, the content is loaded from there.
 
         path (str): The full path where to load the cache from.
 
+        base_url (str): The base URL to resolve relative URLs against when
+        loading an entry from a store directly.
+
         Return: A new ``Meta` instance if it could be successfully reloaded,
         or None if it the path didn't exist or another error occured.
         """
         meta = Meta(-1)
+        meta._dirty = False
 
         try:
-            with open(path, "r") as fp:
-                cached_data = json.load(fp=fp)
-            meta._resources = cached_data['resources']
-            meta._cache = cached_data['cache-id']
+            with open(path, "rb") as fp:
+                if fp.read(len(_CacheMagic)) == _CacheMagic:
+                    meta._loadIndex(fp, base_url)
+                else:
+                    fp.seek(0)
+                    meta._loadJSON(fp)
+
             meta.from_cache = True
 
         except:
             # We just ignore any errors.
-            pass
+            meta = Meta(-1)
 
         return meta
 
+    def _loadIndex(self, fp, base_url=None):
+        (length, ) = _CacheHeader.unpack(fp.read(_CacheHeader.size))
+        header = json.loads(fp.read(length).decode("utf8"))
+        base = len(_CacheMagic) + _CacheHeader.size + length
+
+        self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._relative = header.get('relative', False)
+        self._validators = header.get('validators', {})
+
+        if self._relative:
+            self._base_url = base_url
+            self._validators = { base_url + url: v for (url, v) in self._validators.items() }
+
+        for (url, (offset, length, components)) in header['index'].items():
+            if self._relative:
+                url = base_url + url
+
+            self._components[url] = components
+            self._records[url] = (base + offset, length)
+
+        self._cache = header['cache-id']
+        self._index_validators = header.get('index-validators', {})
+        self._validated = header.get('validated', 0)
+
+    def _loadPointer(self, pointer):
+        obj = pointer['object']
+
+        with open(obj, "rb") as fp:
+            if fp.read(len(_CacheMagic)) != _CacheMagic:
+                raise ValueError("not a meta data cache")
+
+            self._loadIndex(fp, pointer['base-url'])
+
+        # Record the use for pruning the store.
+        os.utime(obj)
+
+        self._store = os.path.dirname(obj)
+        self._key = os.path.basename(obj)
+        self._index_validators = pointer.get('index-validators', {})
+        self._validated = pointer.get('validated', 0)
+
+    def _loadJSON(self, fp):
+        cached_data = json.loads(fp.read().decode("utf8"))
+
+        if 'object' in cached_data:
+            self._loadPointer(cached_data)
+            return
+
+        for (url, meta) in cached_data['resources'].items():
+            self.add(url, meta)
+
+        self._cache = cached_data['cache-id']
+        self._validators = cached_data.get('validators', {})
+        self._index_validators = cached_data.get('index-validators', {})
+        self._validated = cached_data.get('validated', 0)
+
+        # Migrate to the current format.
+        self._dirty = True
+
     def __iter__(self):
-        return self._resources.items().__iter__()
+        return self.select()
+
+def _topLevelComponents(meta):
+    """
+    Returns the sorted list of top-level components that a URL's meta data
+    provides commands for.
+    """
+    try:
+        return sorted(set(r["component"][0] for r in meta if r and r.get("component")))
+    except (TypeError, AttributeError, KeyError):
+        return []
 
-def load(session, base_url, force=False, cache_file=None):
+def _rebase(meta, base_url):
+    """
+    Turns the resource URLs in a URL's meta data from being relative to a
+    base URL into being absolute.
+    """
+    return [(dict(r, resource=base_url + r["resource"]) if r and "resource" in r else r) for r in meta]
+
+def _relativize(meta, base_url):
+    """
+    Turns the resource URLs in a URL's meta data from being absolute into
+    being relative to a base URL.
+    """
+    return [(dict(r, resource=r["resource"][len(base_url):]) if r and "resource" in r else r) for r in meta]
+
+# Number of seconds after which unused entries are removed from a store.
+_StoreExpiration = 30 * 24 * 60 * 60
+
+# Names of the entries in a store, as returned by storeKey().
+_StoreEntryName = re.compile("^[0-9a-f]{64}$")
+
+def _pruneStore(store):
+    """
+    Removes entries from a store that haven't been used for a while. Lock
+    files stay in place: removing one while another process holds the
+    lock would let a third process take the same lock again.
+    """
+    cutoff = time.time() - _StoreExpiration
+
+    for name in os.listdir(store):
+        if not _StoreEntryName.match(name):
+            continue
+
+        path = os.path.join(store, name)
+
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+
+        except OSError:
+            # Removed concurrently.
+            pass
+
+def storeKey(cache, urls, base_url):
+    """
+    Computes the key identifying a set of meta data in a store.
+
+    cache (str): The cache ID the server reported for the meta data.
+
+    urls (list of str): The URLs in the API index.
+
+    base_url (string): The base URL of the API.
+
+    Returns: A string with the key, or None if the index contains URLs
+    that aren't below the base URL, so the meta data can't be shared with
+    other devices.
+    """
+    if any(not url.startswith(base_url) for url in urls):
+        return None
+
+    index = sorted(url[len(base_url):] for url in urls)
+    data = json.dumps([cache, index], separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+def load(session, base_url, force=False, cache_file=None, workers=1, ttl=0, store=None):
     """
     Downloads the complete set of meta information from a Corelight Sensor.
 
+    If the meta data needs to be downloaded, only one process does so at
+    a time for the same cache file, or for the same entry in the store.
+    Any others wait for it to finish and then reuse what it saved.
+
     session (client.session.Session): The session object to use for
     requests.
 
     base_url (string): The base URL of the Corelight Sensor's API interface.
 
-    cache_file (str): File where to load cached meta data from if it exists.
+    cache_file (str): File where to load cached meta data from if it
+    exists. The meta data is saved back there if it has changed.
+
+    workers (int): Maximum number of meta data requests to have in flight
+    concurrently.
+
+    ttl (int): Number of seconds for which cached meta data is used
+    without checking back with the server. Zero means always checking.
+
+    store (str): Directory of a store for sharing meta data between
+    devices with the same API. If the store has the meta data already,
+    it's used without downloading it again.
+
+    Raises ``client.session.SessionError`` if the meta data cannot be
+    retrieved.
     """
-    (_, schema, cache, data) = session.retrieveResource(base_url, debug_level=2)
+    cached_meta = None
+    headers = {}
+
+    if cache_file and not force:
+        cached_meta = _loadCached(cache_file)
+
+        if not cached_meta.from_cache:
+            cached_meta = None
+
+        elif 0 <= cached_meta.age() < ttl:
+            client.util.debug("Using cached meta data without revalidation ({:.0f}s old)".format(cached_meta.age()), level=2)
+            return cached_meta
+
+        else:
+            headers = cached_meta.indexValidators()
+
+    (response, schema, cache, data) = session.retrieveResource(base_url, headers=headers, debug_level=2)
+
+    if response.status_code == 304 and cached_meta:
+        # Index not modified, can reuse cached meta data.
+        if ttl > 0:
+            cached_meta.touch()
+
+        return _save(cached_meta, cache_file)
 
     if schema != "index":
         if data and 'message' in data:
-            client.util.fatalError(data['message'], base_url)
+            raise client.session.SessionError(data['message'], base_url, response.status_code)
         else:
-            client.util.fatalError("URL not pointing to API base address", base_url)
+            raise client.session.SessionError("URL not pointing to API base address", base_url, response.status_code)
 
-    if cache_file and not force:
-        cached_meta = Meta.load(cache_file)
+    previous = None
 
+    if cached_meta:
         if cached_meta.cacheID() == cache:
             # Same cache ID, can reuse cached meta data.
-            return cached_meta
+            if ttl > 0:
+                cached_meta.touch()
+                cached_meta.setIndexValidators(response)
+
+            return _save(cached_meta, cache_file)
+
+        # Revalidate what we have individually, so that we only download
+        # the meta data that actually changed.
+        previous = cached_meta
+
+    key = (storeKey(cache, data, base_url) if store else None)
 
-    meta = Meta(cache)
+    if key:
+        os.makedirs(store, mode=0o700, exist_ok=True)
+        lock = os.path.join(store, key)
+    else:
+        lock = cache_file
 
-    for url in data:
-        _loadResource(session, meta, url)
+    with (client.util.lockFile(lock) if lock else contextlib.suppress()):
+        # If we had to wait for the lock, another process may have just
+        # saved what we need.
+        meta = (_findSaved(cache, base_url, cache_file, store, key) if not force else None)
+
+        if meta:
+            meta.setIndexValidators(response)
+            meta.touch()
+
+        else:
+            meta = Meta(cache)
+            meta.setIndexValidators(response)
+
+            if key:
+                meta.setStore(store, key, base_url)
+
+            _loadResources(session, meta, data, workers, previous)
+
+        return _save(meta, cache_file)
+
+def _findSaved(cache, base_url, cache_file, store, key):
+    """
+    Looks for saved meta data with a given cache ID, first in the cache
+    file and then in the store.
+
+    Returns: A ``Meta`` instance, or None if not found.
+    """
+    if cache_file:
+        meta = Meta.load(cache_file)
+
+        if meta.cacheID() == cache:
+            return meta
+
+    if key:
+        obj = os.path.join(store, key)
+        meta = Meta.load(obj, base_url)
+
+        if meta.cacheID() == cache:
+            # Another device with the same API has stored the meta data.
+            client.util.debug("Using shared meta data {}".format(obj), level=2)
+            os.utime(obj)
+            meta.setStore(store, key, base_url)
+            return meta
+
+    return None
+
+def _loadCached(cache_file):
+    """
+    Loads meta data from a cache file, reusing what an earlier invocation
+    within the same process loaded from there if the file hasn't changed
+    since.
+    """
+    status = _fileStatus(cache_file)
+    (loaded_status, meta) = _Loaded.get(cache_file, (None, None))
+
+    if status and loaded_status == status:
+        client.util.debug("Using meta data already in memory", level=2)
+        return meta
+
+    meta = Meta.load(cache_file)
+
+    if status and meta.from_cache:
+        _Loaded[cache_file] = (status, meta)
+
+    return meta
+
+def _save(meta, cache_file):
+    """Saves meta data to a cache file if it has changed, and returns it."""
+    if cache_file:
+        if meta.needsSave():
+            meta.save(cache_file)
+
+        status = _fileStatus(cache_file)
+
+        if status:
+            _Loaded[cache_file] = (status, meta)
 
     return meta
 
-def _loadResource(session, meta, url):
-    if meta.get(url):
+def _fileStatus(path):
+    """Returns a tuple identifying a file's current content, or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _loadResources(session, meta, urls, workers, previous=None):
+    """
+    Retrieves the meta data for a list of URLs and adds it to a ``Meta``
+    instance. Requests are spread across up to *workers* threads sharing the
+    session's connection pool. Results are added in the order of *urls*
+    independent of when they arrive, and if any of the requests fails, the
+    error of the first failing URL in that order is raised.
+
+    previous (Meta): Outdated meta data to revalidate. For URLs that
+    come with a validator there, a conditional request is sent and the
+    previous meta data is reused if the server reports it as unmodified.
+    """
+    # Remove duplicates, preserving order.
+    urls = [url for url in dict.fromkeys(urls) if not meta.get(url)]
+
+    if client.util.debugLevel() >= 2:
+        # Keep the debug output of the individual requests from interleaving.
+        workers = 1
+
+    if workers <= 1 or len(urls) <= 1:
+        for url in urls:
+            _addResource(meta, url, _retrieveResource(session, url, previous))
+
         return
 
-    (res, schema, _, data) = session.retrieveResource(url, method="OPTIONS", debug_level=2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        futures = [executor.submit(_retrieveResource, session, url, previous) for url in urls]
+
+        try:
+            for (url, future) in zip(urls, futures):
+                _addResource(meta, url, future.result())
+
+        except:
+            for future in futures:
+                future.cancel()
+
+            raise
+
+def _retrieveResource(session, url, previous=None):
+    """
+    Retrieves the meta data for a single URL.
+
+    previous (Meta): Outdated meta data to revalidate, or None.
+
+    Returns: A 3-tuple ``(string, any, string)`` with the schema, the
+    decoded meta data, and its validator. If the previous meta data is
+    still valid, the schema is None.
+    """
+    cached = (previous.get(url) if previous else None)
+    validator = (previous.validator(url) if previous else None)
+    headers = {}
+
+    if cached and validator:
+        headers["If-None-Match"] = validator
+
+    (res, schema, _, data) = session.retrieveResource(url, method="OPTIONS", headers=headers, debug_level=2)
+
+    if res.status_code == 304 and cached:
+        # Not modified.
+        return (None, cached, validator)
 
     success = (res.status_code >= 200 and res.status_code < 300)
 
     if not success:
-        raise session.SessionError("Bad HTTP response code while retriecving metadata", url, res.status_code)
+        raise client.session.SessionError("Bad HTTP response code while retriecving metadata", url, res.status_code)
+
+    return (schema, data, res.headers.get("ETag", None))
+
+def _addResource(meta, url, result):
+    (schema, data, validator) = result
 
     if schema == "index":
         return
 
-    meta.add(url, data)
+    meta.add(url, data, validator)
 
 def _parseLinks(response, rel):
     """
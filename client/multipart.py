@@ -1,7 +1,8 @@
-import contextlib
 from uuid import uuid4
 import io
+import mmap
 import os
+import stat
 from ._compat import fields
 
 class MultipartEncoder(object):
@@ -83,6 +84,12 @@ class MultipartEncoder(object):
             encode_with('\r\n', self.encoding)
             ])
 
+        # Pre-encoded boundary terminating the body
+        self._encoded_closing_boundary = b''.join([
+            encode_with(self.boundary, self.encoding),
+            encode_with('--\r\n', self.encoding)
+            ])
+
         #: Fields provided by the user
         self.fields = fields
 
@@ -102,13 +109,16 @@ class MultipartEncoder(object):
         self._len = None
 
         # Our buffer
-        self._buffer = CustomBytesIO(encoding=encoding)
+        self._buffer = CursorBuffer(capacity=BUFFER_CAPACITY)
 
         # Pre-compute each part's headers
         self._prepare_parts()
 
         # Load boundary into buffer
-        self._write_boundary()
+        if self.parts:
+            self._write_boundary()
+        else:
+            self._write_closing_boundary()
 
     @property
     def len(self):
@@ -169,17 +179,18 @@ class MultipartEncoder(object):
 
     def _load(self, amount):
         """Load ``amount`` number of bytes into the buffer."""
-        self._buffer.smart_truncate()
         part = self._current_part or self._next_part()
         while amount == -1 or amount > 0:
             written = 0
             if part and not part.bytes_left_to_write():
                 written += self._write(b'\r\n')
-                written += self._write_boundary()
                 part = self._next_part()
+                if part:
+                    written += self._write_boundary()
+                else:
+                    written += self._write_closing_boundary()
 
             if not part:
-                written += self._write_closing_boundary()
                 self.finished = True
                 break
 
@@ -244,10 +255,7 @@ class MultipartEncoder(object):
 
     def _write_closing_boundary(self):
         """Write the bytes necessary to finish a multipart/form-data body."""
-        with reset(self._buffer):
-            self._buffer.seek(-2, 2)
-            self._buffer.write(b'--\r\n')
-        return 2
+        return self._write(self._encoded_closing_boundary)
 
     def _write_headers(self, headers):
         """Write the current part's headers to the buffer."""
@@ -285,11 +293,21 @@ class MultipartEncoder(object):
         :param int size: (optional), If provided, ``read`` will return exactly
             that many bytes. If it is not provided, it will return the
             remaining bytes.
-        :returns: bytes
+        :returns: bytes, or a memoryview into the file being sent when
+            reading from the middle of a memory-mapped file part
         """
         if self.finished:
             return self._buffer.read(size)
 
+        part = self._current_part
+        if (size is not None and size > 0 and part and
+                not part.headers_unread and
+                isinstance(part.body, FileWrapper) and
+                part.body.len >= size and not total_len(self._buffer)):
+            # Hand out the file's pages directly instead of copying them
+            # through the buffer.
+            return part.body.read(size)
+
         bytes_to_load = size
         if bytes_to_load != -1 and bytes_to_load is not None:
             bytes_to_load = self._calculate_load_amount(int(size))
@@ -297,6 +315,42 @@ class MultipartEncoder(object):
         self._load(bytes_to_load)
         return self._buffer.read(size)
 
+    def send_to(self, sock):
+        """Send the remaining body to a socket.
+
+        File parts are sent with ``socket.sendfile()``, which has the kernel
+        copy them to the socket directly where the platform supports it.
+
+        :param socket.socket sock: the connected socket to send the body to
+        """
+        if self._current_part is not None or self.finished:
+            # Already partially read, send what's left the regular way.
+            while True:
+                data = self.read(SEND_CHUNK_SIZE)
+                if not data:
+                    return
+                sock.sendall(data)
+
+        for part in self.parts:
+            sock.sendall(self._encoded_boundary + part.headers)
+            part.headers_unread = False
+
+            if isinstance(part.body, FileWrapper):
+                part.body.send_to(sock)
+            else:
+                while total_len(part.body) > 0:
+                    sock.sendall(part.body.read(SEND_CHUNK_SIZE))
+
+            sock.sendall(b'\r\n')
+
+        sock.sendall(self._encoded_closing_boundary)
+        self._buffer.read()
+        self.finished = True
+
+#: Amount of data to send at a time when a part cannot be sent through
+#: ``socket.sendfile()``.
+SEND_CHUNK_SIZE = 1024 * 1024
+
 def total_len(o):
     if hasattr(o, '__len__'):
         return len(o)
@@ -316,41 +370,74 @@ def total_len(o):
         # e.g. BytesIO, cStringIO.StringIO
         return len(o.getvalue())
 
-@contextlib.contextmanager
-def reset(buffer):
-    """Keep track of the buffer's current position and write to the end.
+class FileWrapper(object):
+    """Wraps a file for reading it into a multipart body.
 
-    This is a context manager meant to be used when adding data to the buffer.
-    It eliminates the need for every function to be concerned with the
-    position of the cursor in the buffer.
+    Regular files are memory-mapped, so that reads return views of the
+    file's pages instead of copies, and the remaining length is known without
+    asking the OS each time. Pages are unmapped again once the next read
+    shows that the previous data has been consumed.
     """
-    original_position = buffer.tell()
-    buffer.seek(0, 2)
-    yield
-    buffer.seek(original_position, 0)
-
-class FileWrapper(object):
     def __init__(self, file_object):
         self.fd = file_object
+        self._view = None
+
+        try:
+            fileno = file_object.fileno()
+            st = os.fstat(fileno)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+                self._pos = file_object.tell()
+                self._released = 0
+                self._size = st.st_size
+        except (OSError, ValueError, io.UnsupportedOperation):
+            self._view = None
 
     @property
     def len(self):
+        if self._view is not None:
+            return self._size - self._pos
+
         return total_len(self.fd) - self.fd.tell()
 
     def read(self, length=-1):
-        return self.fd.read(length)
+        if self._view is None:
+            return self.fd.read(length)
+
+        start = self._pos
+        end = self._size if length is None or length < 0 else min(self._size, start + length)
+        self._pos = end
+        self._release(start)
+        return self._view[start:end]
+
+    def _release(self, offset):
+        """Unmap the pages before ``offset`` to keep memory usage flat."""
+        offset -= offset % mmap.PAGESIZE
+        if offset > self._released and hasattr(mmap, 'MADV_DONTNEED'):
+            self._map.madvise(mmap.MADV_DONTNEED, self._released, offset - self._released)
+            self._released = offset
+
+    def send_to(self, sock):
+        """Send the rest of the file to a socket through ``socket.sendfile()``."""
+        if self._view is None:
+            sock.sendfile(self.fd)
+            return
+
+        sock.sendfile(self.fd, self._pos, self._size - self._pos)
+        self._pos = self._size
     
 def coerce_data(data, encoding):
     """Ensure that every object's __len__ behaves uniformly."""
-    if not isinstance(data, CustomBytesIO):
+    if not isinstance(data, CursorBuffer):
         if hasattr(data, 'getvalue'):
-            return CustomBytesIO(data.getvalue(), encoding)
+            return CursorBuffer(data.getvalue(), encoding)
 
         if hasattr(data, 'fileno'):
             return FileWrapper(data)
 
         if not hasattr(data, 'read'):
-            return CustomBytesIO(data, encoding)
+            return CursorBuffer(data, encoding)
 
     return data
 
@@ -386,7 +473,7 @@ class Part(object):
         The number of bytes written may exceed size on the first read since we
         load the headers ambitiously.
 
-        :param CustomBytesIO buffer: buffer we want to write bytes to
+        :param CursorBuffer buffer: buffer we want to write bytes to
         :param int size: number of bytes requested to be written to the buffer
         :returns: int -- number of bytes actually written
         """
@@ -403,38 +490,86 @@ class Part(object):
 
         return written
     
-class CustomBytesIO(io.BytesIO):
-    def __init__(self, buffer=None, encoding='utf-8'):
-        buffer = encode_with(buffer, encoding)
-        super(CustomBytesIO, self).__init__(buffer)
-
-    def _get_end(self):
-        current_pos = self.tell()
-        self.seek(0, 2)
-        length = self.tell()
-        self.seek(current_pos, 0)
-        return length
+#: Initial capacity of an encoder's buffer.
+BUFFER_CAPACITY = 64 * 1024
+
+class CursorBuffer(object):
+    """A byte buffer with separate read and write cursors.
+
+    Data is appended at the write cursor and consumed from the read cursor,
+    so neither appending nor reading moves data that's already in the
+    buffer, and the amount of unread data is known without seeking. Once
+    everything has been read, both cursors go back to the start and the
+    space gets reused. Unread data is moved to the front only when there's
+    no room left behind it.
+
+    A buffer created with initial content and never appended to hands out
+    views of that content instead of copies.
+    """
+    def __init__(self, buffer=None, encoding='utf-8', capacity=0):
+        data = encode_with(buffer, encoding) or b''
+        if capacity:
+            self._data = bytearray(max(capacity, len(data)))
+            self._data[:len(data)] = data
+        else:
+            # Kept as is until something gets appended.
+            self._data = data
+        self._start = 0
+        self._end = len(data)
 
     @property
     def len(self):
-        length = self._get_end()
-        return length - self.tell()
+        return self._end - self._start
 
-    def append(self, bytes):
-        with reset(self):
-            written = self.write(bytes)
-        return written
+    def append(self, data):
+        """Append data at the write cursor.
+
+        :param data: bytes-like object to append
+        :returns: int -- the number of bytes appended
+        """
+        n = len(data)
+        if self._end + n > len(self._data) or not isinstance(self._data, bytearray):
+            self._make_room(n)
+        self._data[self._end:self._end + n] = data
+        self._end += n
+        return n
+
+    def _make_room(self, n):
+        unread = self._end - self._start
+        if self._start or not isinstance(self._data, bytearray):
+            data = bytearray(max(len(self._data), unread + n))
+            data[:unread] = self._data[self._start:self._end]
+            self._data = data
+            self._start = 0
+            self._end = unread
+        if unread + n > len(self._data):
+            # Grow geometrically to keep appends amortized O(1).
+            self._data.extend(bytes(max(unread + n, 2 * len(self._data)) - len(self._data)))
+
+    def read(self, size=-1):
+        """Read data from the read cursor.
+
+        :param int size: (optional) maximum number of bytes to read; all
+            unread data if not given
+        :returns: bytes, or a memoryview when reading initial content
+        """
+        available = self._end - self._start
+        if size is None or size < 0 or size > available:
+            size = available
+
+        start = self._start
+        self._start += size
+
+        if not isinstance(self._data, bytearray):
+            return memoryview(self._data)[start:start + size]
+
+        with memoryview(self._data) as view:
+            data = bytes(view[start:start + size])
 
-    def smart_truncate(self):
-        to_be_read = total_len(self)
-        already_read = self._get_end() - to_be_read
+        if self._start == self._end:
+            self._start = self._end = 0
 
-        if already_read >= to_be_read:
-            old_bytes = self.read()
-            self.seek(0, 0)
-            self.truncate()
-            self.write(old_bytes)
-            self.seek(0, 0)  # We want to be at the beginning
+        return data
 
 def encode_with(string, encoding):
     """Encoding ``string`` with ``encoding`` if necessary.
@@ -4,17 +4,65 @@
 
 import base64
 import binascii
+import collections.abc
+import email.utils
+import hashlib
 import json
 import os
 import os.path
+import shutil
 import sys
+import tempfile
 import time
 
+import client.jobs
 import client.util
 
 # The format for the readable ASCII representation of times the API returns.
 _TimeFormat = "%Y-%m-%d %H:%M:%S %Z"
 
+# Number of base64 characters we decode at a time when saving files. Must
+# be a multiple of 4.
+_DecodeChunkSize = 1024 * 1024
+
+# Minimum size in bytes of a file for showing progress while saving it.
+_ProgressMinSize = 16 * 1024 * 1024
+
+# Seconds to wait before the second check for the result of an asynchronous
+# operation. The wait doubles for every further check, up to
+# _PollMaxDelay.
+_PollInitialDelay = 0.25
+
+# Maximum seconds to wait between checks for the result of an asynchronous
+# operation.
+_PollMaxDelay = 5
+
+# Maximum seconds we ask the server to hold on to a check for the result of
+# an asynchronous operation until it becomes available.
+_PollWait = 10
+
+# Maximum seconds to wait when the server asks us to through Retry-After.
+_PollMaxRetryAfter = 60
+
+# Maximum size in bytes of a file to upload that we keep in memory for
+# sending it again after a confirmation. Larger ones go to a temporary
+# file.
+_SpoolMemorySize = 1024 * 1024
+
+class ResourceError(Exception):
+    """
+    Error preparing a request for a resource, or processing its response,
+    other than the device reporting an error itself.
+    """
+    def __init__(self, msg, arg=None):
+        super(ResourceError, self).__init__(msg + (" ({})".format(arg) if arg else ""))
+        self._msg = msg
+        self._arg = arg
+
+    def fatalError(self):
+        """Triggers a fatal error reporting the exception's information."""
+        client.util.fatalError(self._msg, self._arg)
+
 def _prepareParameters(resource, key, values, params, files):
     """
     Prepares paramaters and fields for a request.
@@ -35,6 +83,7 @@ def _prepareParameters(resource, key, values, params, files):
     be added that are to be uploaded as files in a form.
 
     Returns: Nothing, but *params* and *files* will be adapted as suitable.
+    Raises ``ResourceError`` if a file cannot be read.
     """
     for p in resource.get(key, []):
         name = p["name"]
@@ -65,10 +114,10 @@ def _prepareParameters(resource, key, values, params, files):
                     params[name] = file.read().decode("utf8")
 
             except IOError as e:
-                client.util.fatalError("Cannot open file {}".format(value), e)
+                raise ResourceError("Cannot open file {}".format(value), e)
 
             except UnicodeDecodeError:
-                client.util.fatalError("The file {} contains non-UTF8 characters, which the parameter '{}' does not support".format(value, name))
+                raise ResourceError("The file {} contains non-UTF8 characters, which the parameter '{}' does not support".format(value, name))
 
         elif type == "dictionary":
             params[name] = value
@@ -116,24 +165,106 @@ def _renderObject(response_fields_by_name, obj, hide):
 
     return client.util.formatTuples(values)
 
-def _saveFiles(response_fields, obj):
+def _dumpCollection(objs):
+    """
+    Helper function to print a collection as JSON, one element at a time.
+    The output is the same as that of ``json.dump()`` for a list.
+
+    objs (iterator of any): The collection's elements.
+    """
+    empty = True
+
+    for obj in objs:
+        sys.stdout.write("[\n  " if empty else ",\n  ")
+        sys.stdout.write(json.dumps(obj, indent=2, sort_keys=True).replace("\n", "\n  "))
+        empty = False
+
+    sys.stdout.write("[]" if empty else "\n]")
+
+def _decodeFile(content, fname, digest):
+    """
+    Helper function decoding a file's base64 content in chunks, so that the
+    decoded file never needs to be in memory all at once. Reports progress
+    for large files if standard error is a terminal.
+
+    content (str): The base64 content.
+
+    fname (str): The name of the file being saved, for progress output.
+
+    digest (hashlib.hash): If not None, updated with the decoded data.
+
+    Returns: An iterator yielding the decoded data in chunks.
+    """
+    total = len(content) * 3 // 4
+    progress = (total >= _ProgressMinSize and sys.stderr.isatty())
+    shown = None
+    rest = ""
+
+    for i in range(0, len(content), _DecodeChunkSize):
+        chunk = content[i:i + _DecodeChunkSize]
+
+        if "\n" in chunk or "\r" in chunk or " " in chunk:
+            # Line breaks would throw off our 4-character alignment.
+            chunk = "".join(chunk.split())
+
+        chunk = rest + chunk
+        n = len(chunk) - len(chunk) % 4
+        rest = chunk[n:]
+
+        try:
+            data = base64.standard_b64decode(chunk[:n])
+        except (binascii.Error, ValueError):
+            raise ResourceError("cannot decode server's base64 file content")
+
+        if digest:
+            digest.update(data)
+
+        if progress:
+            percent = min(100, (i + _DecodeChunkSize) * 100 // len(content))
+
+            if percent != shown:
+                print("\rSaving {}: {}%".format(fname, percent), end="", file=sys.stderr)
+                sys.stderr.flush()
+                shown = percent
+
+        yield data
+
+    if rest:
+        raise ResourceError("cannot decode server's base64 file content")
+
+    if progress:
+        print("\r\033[K", end="", file=sys.stderr)
+        sys.stderr.flush()
+
+def _saveFiles(response_fields, obj, checksum=None, directory=None):
     """
     Helper function to save any files embedded in the response to disk.
+    Raises ``ResourceError`` if a file cannot be saved.
+
+    checksum (str): If not None, the name of a ``hashlib`` algorithm to
+    compute a checksum of each file with.
+
+    directory (str): The directory where to save the files. Defaults to
+    the current directory.
+
+    Returns: A dictionary mapping the name of each response field that
+    held a file to a 2-tuple ``(str, str)`` with the path the file was
+    saved to, and its checksum in hex, or None if not computed.
     """
+    saved = {}
+
     for f in response_fields:
         if f["type"] != "file" or not f["name"] in obj:
             continue
 
         file = obj[f["name"]]
 
-        try:
-            content = base64.standard_b64decode(file["content"])
-        except binascii.Error:
-            client.util.fatalError("cannot decode server's base64 file content")
-
         # Save content, but don't overwrite existing files.
         fname = file["name"]
 
+        if directory:
+            fname = os.path.join(directory, os.path.basename(fname))
+
         if os.path.exists(fname):
             c = 2
             while True:
@@ -146,14 +277,26 @@ def _saveFiles(response_fields, obj):
                 c += 1
 
         try:
-            out = open(fname, "wb")
-            out.write(content)
-            out.close()
+            digest = (hashlib.new(checksum) if checksum else None)
+        except ValueError:
+            raise ResourceError("unsupported checksum algorithm", checksum)
+
+        start = time.time()
 
-            print("Saved {}".format(fname))
+        try:
+            client.util.writeFile(fname, _decodeFile(file["content"], fname, digest))
 
         except IOError as e:
-            client.util.fatalError("error saving file", e)
+            raise ResourceError("error saving file", e)
+
+        if client.util.debugLevel():
+            size = os.path.getsize(fname)
+            secs = max(time.time() - start, 1e-6)
+            client.util.debug("+ Saved {} bytes to {} in {:.3f}s ({:.1f} MB/s)".format(size, fname, secs, size / secs / 1e6))
+
+        saved[f["name"]] = (fname, (digest.hexdigest() if digest else None))
+
+    return saved
 
 def _responseString(resource, status_code, default=None):
     """
@@ -198,24 +341,38 @@ def process(session, resource, force_url=None):
 
     Returns: Nothing
     """
-    values = vars(session.arguments())
+    try:
+        request = _prepareRequest(session, resource)
+    except ResourceError as e:
+        e.fatalError()
 
+    _sendRequest(session, resource, request, force_url)
+
+def _prepareRequest(session, resource, values=None):
+    """
+    Prepares the request for accessing a resource, reading any files that
+    it needs. Raises ``ResourceError`` if a file cannot be read.
+
+    session (client.session.Session): The session object to use for
+    requests.
+
+    resource (dict): The meta information for the resource to access.
+
+    values (dict string of any): Dictionary mapping the names of the
+    resource's parameters, request fields, and variables, with dashes
+    replaced by underscores, to the values to send. If not given, the
+    values come from the command line options and standard input.
+
+    Returns: A dictionary with keys ``url``, ``method``, ``params``,
+    ``json``, and ``files`` describing the request. For resources that
+    may require confirmation, any files are spooled so that the request
+    can be sent a second time without reading them again.
+    """
     url = resource["resource"]
     method = resource.get("method", "GET")
 
-    try:
-        if session.arguments().stdin:
-            try:
-                # Read additional options from standard input.
-                d = json.load(fp=sys.stdin)
-                values.update({ k.replace("-", "_"): v for (k, v) in d.items() })
-            except ValueError:
-                print("Cannot parse JSON on standard input.", file=sys.stderr)
-                sys.exit(1)
-
-    except AttributeError:
-        # No --stdin option.
-        pass
+    if values is None:
+        values = _argumentValues(session)
 
     params = {}
     fields = {}
@@ -227,6 +384,9 @@ def process(session, resource, force_url=None):
     _prepareParameters(resource, "parameters", values, params, None)
     _prepareParameters(resource, "request-fields", values, fields, files)
 
+    if resource.get("requires-confirmation", False):
+        _spoolFiles(files)
+
     if not files:
         json_arg = fields
     else:
@@ -244,20 +404,106 @@ def process(session, resource, force_url=None):
         k = d["name"]
         url = url.replace("{" + k + "}", str(values[k]))
 
-    ### Request resource.
+    return {"url": url, "method": method, "params": params, "json": json_arg, "files": files}
 
-    if force_url:
-        url = force_url
-        params = {}
+def _argumentValues(session):
+    """
+    Returns the values to send with a request as given by the command
+    line options, updated with any read from standard input.
+    """
+    values = vars(session.arguments())
 
     try:
-        (response, schema, cache, data) = session.retrieveResource(url, method=method, params=params, json=json_arg, files=files)
+        if session.arguments().stdin:
+            try:
+                # Read additional options from standard input.
+                d = json.load(fp=sys.stdin)
+                values.update({ k.replace("-", "_"): v for (k, v) in d.items() })
+            except ValueError:
+                print("Cannot parse JSON on standard input.", file=sys.stderr)
+                sys.exit(1)
+
+    except AttributeError:
+        # No --stdin option.
+        pass
+
+    return values
+
+def _spoolFiles(files):
+    """
+    Replaces the files to upload with copies that can be read repeatedly,
+    closing the originals. Small files are kept in memory, larger ones in
+    temporary files.
+
+    files (dict): Form fields in the format of the ``requests`` ``files``
+    argument, as prepared by ``_prepareParameters``.
+    """
+    for (key, (name, file, content_type)) in files.items():
+        with file:
+            data = file.read(_SpoolMemorySize + 1)
+
+            if len(data) > _SpoolMemorySize:
+                spool = tempfile.TemporaryFile()
+                spool.write(data)
+                shutil.copyfileobj(file, spool, _SpoolMemorySize)
+                spool.seek(0)
+                data = spool
+
+        files[key] = (name, data, content_type)
+
+def _sendRequest(session, resource, request, force_url=None):
+    """
+    Sends a prepared request and processes the response.
+
+    session (client.session.Session): The session object to use for
+    requests.
+
+    resource (dict): The meta information for the resource to access and
+    process.
+
+    request (dict): The request as returned by ``_prepareRequest``. It may
+    be sent again after a confirmation.
+
+    force_url (None): If given, send the request to this URL instead,
+    without any query parameters.
+    """
+    try:
+        (response, schema, cache, data) = _retrieveRequest(session, request, force_url)
     except client.session.SessionError as e:
         e.fatalError()
 
-    _processResponse(session, resource, response, schema, cache, data)
+    _processResponse(session, resource, response, schema, cache, data, request)
+
+def _retrieveRequest(session, request, force_url=None):
+    """
+    Sends a prepared request. Raises ``client.session.SessionError`` if
+    it fails.
+
+    session (client.session.Session): The session object to use for
+    requests.
+
+    request (dict): The request as returned by ``_prepareRequest``.
+
+    force_url (None): If given, send the request to this URL instead,
+    without any query parameters.
+
+    The return value matches that of ``client.util.retrieveResource``.
+    """
+    url = request["url"]
+    params = request["params"]
+
+    if force_url:
+        url = force_url
+        params = {}
+
+    for file in request["files"].values():
+        # Start over if sending again.
+        if hasattr(file[1], "seek"):
+            file[1].seek(0)
+
+    return session.retrieveResource(url, method=request["method"], params=params, json=request["json"], files=request["files"], stream=True)
 
-def _processResponse(session, resource, response, schema, cache, data):
+def _processResponse(session, resource, response, schema, cache, data, request=None):
     """
     Processes the response after retrieving a resource. This funtion does *not*
     handle ``202 Accepted``.
@@ -268,6 +514,10 @@ def _processResponse(session, resource, response, schema, cache, data):
     resource (dict): The meta information for the resource to access and
     process.
 
+    request (dict): The request that was sent, as returned by
+    ``_prepareRequest``, for sending it again once confirmed. If not
+    given, a confirmation prepares the request anew.
+
     The other parameters match the result of ``client.util.retrieveResource``.
     """
     status = response.status_code
@@ -280,31 +530,8 @@ def _processResponse(session, resource, response, schema, cache, data):
     if not success:
         ### Problem with the request, print error message.
 
-        title = data.get("title", "")
-        description = data.get("description", "")
-        diagnostics = data.get("diagnostics", "").strip()
-
-        msg = _responseString(resource, status)
-
-        if title and description:
-            error = "Error: {}. {}".format(title, description)
-
-        elif title:
-            error = "Error: " + title
-
-        elif description:
-            error = "Error: " + description
-
-        elif msg:
-            error = "Error: " + msg
-
-        else:
-            error = "Error: {} {}".format(status, response.reason)
-
-        if not error.endswith("."):
-            error += "."
-
-        print(error, file=sys.stderr)
+        (error, diagnostics) = _errorMessage(resource, response, data)
+        print("Error: " + error, file=sys.stderr)
 
         if diagnostics:
             print("\nDiagnostics:", file=sys.stderr)
@@ -323,10 +550,19 @@ def _processResponse(session, resource, response, schema, cache, data):
         if msg:
             print(msg)
 
-        (response, schema, cache, data) = _waitForResult(session, response)
-        _processResponse(session, resource, response, schema, cache, data)
+        try:
+            (response, schema, cache, data) = _waitForResult(session, response)
+        except client.session.SessionError as e:
+            e.fatalError()
+
+        _processResponse(session, resource, response, schema, cache, data, request)
         return
 
+    if status == 202 and response.headers.get("location", None):
+        # Not waiting, remember the operation for "jobs wait".
+        id = client.jobs.record(session.arguments(), resource, response.headers["location"])
+        print("Started job {}. Use \"jobs wait --ids {}\" to retrieve its result.".format(id, id))
+
     if schema == "confirmation":
         # A confirmation is required, ask for it.
         msg = data["message"]
@@ -349,16 +585,32 @@ def _processResponse(session, resource, response, schema, cache, data):
             print()
 
         # Reissue the request with the URL we got.
-        return process(session, resource, url)
+        if request is None:
+            return process(session, resource, url)
+
+        return _sendRequest(session, resource, request, url)
 
     if response_fields:
         hide = set([f["name"] for f in response_fields if not f.get("display", True)])
     else:
         hide = set()
 
+    if schema == "collection":
+        # A streamed collection comes as an iterator, see
+        # ``client.session.Session.retrieveResource``.
+        if isinstance(data, list):
+            data = iter(data)
+
+        elif not isinstance(data, collections.abc.Iterator):
+            client.util.fatalError("server sent a collection that's not a list")
+
     try:
         if session.arguments().json:
-            json.dump(data, fp=sys.stdout, indent=2, sort_keys=True)
+            if schema == "collection":
+                _dumpCollection(data)
+            else:
+                json.dump(data, fp=sys.stdout, indent=2, sort_keys=True)
+
             print()
             return
 
@@ -366,17 +618,16 @@ def _processResponse(session, resource, response, schema, cache, data):
         # No JSON option.
         pass
 
-    if schema == "collection":
-        if not isinstance(data, list):
-            client.util.fatalError("server sent a collection that's not a list")
-
-        if len(data) == 0:
-            print("No entries.")
+    except client.session.SessionError as e:
+        e.fatalError()
 
-        else:
+    if schema == "collection":
+        try:
+            empty = True
             first = True
 
             for obj in data:
+                empty = False
                 robj = _renderObject(response_fields_by_name, obj, hide)
 
                 if not robj:
@@ -388,8 +639,25 @@ def _processResponse(session, resource, response, schema, cache, data):
 
                 print(robj)
 
+        except client.session.SessionError as e:
+            e.fatalError()
+
+        if empty:
+            print("No entries.")
+
     elif schema == "object":
-        _saveFiles(response_fields, data)
+        checksum = getattr(session.arguments(), "checksum", None)
+
+        try:
+            saved = _saveFiles(response_fields, data, checksum)
+        except ResourceError as e:
+            e.fatalError()
+
+        for (fname, hexdigest) in saved.values():
+            if hexdigest:
+                print("Saved {} ({} {})".format(fname, checksum, hexdigest))
+            else:
+                print("Saved {}".format(fname))
 
         robj = _renderObject(response_fields_by_name, data, hide)
         if robj:
@@ -405,36 +673,110 @@ def _processResponse(session, resource, response, schema, cache, data):
         msg = _responseString(resource, status, "Success.")
         print(msg)
 
-def _waitForResult(session, response):
+def _errorMessage(resource, response, data):
+    """
+    Derives the message describing an error response.
+
+    resource (dict): The resource meta information.
+
+    response (requests.Response): The error response.
+
+    data (dict): The response's decoded body.
+
+    Returns: A 2-tuple ``(str, str)`` with the error message, and the
+    diagnostics that the server sent along, or an empty string if none.
+    """
+    status = response.status_code
+    title = data.get("title", "")
+    description = data.get("description", "")
+    diagnostics = data.get("diagnostics", "").strip()
+
+    msg = _responseString(resource, status)
+
+    if title and description:
+        error = "{}. {}".format(title, description)
+
+    elif title:
+        error = title
+
+    elif description:
+        error = description
+
+    elif msg:
+        error = msg
+
+    else:
+        error = "{} {}".format(status, response.reason)
+
+    if not error.endswith("."):
+        error += "."
+
+    return (error, diagnostics)
+
+def _waitForResult(session, response, location=None, progress=True, throttle=None):
     """
     Handle a ``202 Accepted`` response by retrying until the actual response
     becomes available.
 
+    The first check happens right away. After that, the wait between
+    checks grows exponentially up to ``_PollMaxDelay``, unless the server
+    asks for a specific wait through ``Retry-After``. Each check also asks
+    the server to hold on to the request until the result is ready, for up
+    to ``_PollWait`` seconds; servers that do so get checked again right
+    away.
+
     session (client.session.Session): The session object to use for
     requests.
 
-    response (requests.Response): The 202 response object.
+    response (requests.Response): The 202 response object, or None if
+    *location* is given.
+
+    location (str): The URL to check for the result, if known already
+    instead of through *response*.
+
+    progress (bool): True to print progress to standard output while
+    waiting if that's a terminal.
+
+    throttle (callable): If given, called before each check, which it may
+    delay to limit the rate of requests.
+
+    Raises ``client.session.SessionError`` if the result cannot be
+    retrieved.
 
     The return value matches that of ``client.util.retrieveResource``, now
     with the actual response to continue processing with.
     """
     have_output = False
-    update_location = True
+    update_location = (location is None)
     errors_left = 10
+    start = time.time()
+    polls = 0
+    delay = 0
+    backoff = _PollInitialDelay
+
+    read_timeout = getattr(session.arguments(), "read_timeout", 0)
+    wait = (min(_PollWait, read_timeout / 2) if read_timeout else _PollWait)
+    headers = {"Prefer": "wait={}".format(int(wait))} if wait >= 1 else None
 
     while True:
         # Result pending, keep trying.
-        time.sleep(1)
+        time.sleep(delay)
         dot = "."
 
         if update_location:
             location = response.headers.get("location", None)
 
             if not location:
-                client.util.fatalError("202 response from server did not have a location header")
+                raise client.session.SessionError("202 response from server did not have a location header")
+
+        if throttle:
+            throttle()
+
+        polled = time.time()
+        polls += 1
 
         try:
-            (response, schema, cache, data) = session.retrieveResource(location, method="GET")
+            (response, schema, cache, data) = session.retrieveResource(location, method="GET", headers=headers)
 
             if response.status_code == 502:
                 # Bad gateway, which is probably a benign temporary service
@@ -446,9 +788,11 @@ def _waitForResult(session, response):
                 if have_output:
                     print()
 
+                client.util.debug("Job completed after {:.1f}s and {} checks".format(time.time() - start, polls))
                 return (response, schema, cache, data)
 
             update_location = True
+            retry_after = _retryAfter(response)
 
         except client.session.SessionError as e:
             # As we have already communicated with the server before this is
@@ -457,12 +801,41 @@ def _waitForResult(session, response):
             # problem.
             errors_left -= 1
             if errors_left < 0:
-                e.fatalError()
+                raise
 
             dot = "?"
             update_location = False
+            retry_after = None
+
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            # Time the server held on to the request counts as waiting.
+            delay = max(0, backoff - (time.time() - polled))
+            backoff = min(backoff * 2, _PollMaxDelay)
 
-        if sys.stdout.isatty():
+        if progress and sys.stdout.isatty():
             print(dot, end="")
             sys.stdout.flush()
             have_output = True
+
+def _retryAfter(response):
+    """
+    Returns the number of seconds a response's ``Retry-After`` header asks
+    to wait, or None if it doesn't have a valid one. Waits are capped at
+    ``_PollMaxRetryAfter`` seconds.
+    """
+    value = response.headers.get("Retry-After", None)
+
+    if not value:
+        return None
+
+    try:
+        secs = float(value)
+    except ValueError:
+        try:
+            secs = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    return min(max(secs, 0), _PollMaxRetryAfter)
@@ -2,11 +2,17 @@
 #
 # See COPYING for license information.
 
+import codecs
+import json
 import os
+import random
+import re
 import ssl
 import sys
 import urllib.parse
 import socket
+import threading
+import time
 import requests
 import requests.exceptions
 import requests.utils
@@ -15,6 +21,8 @@ import requests.packages.urllib3
 import requests.packages.urllib3.poolmanager
 import requests.packages.urllib3.connection
 import requests.packages.urllib3.connectionpool
+import requests.packages.urllib3.exceptions
+import requests.packages.urllib3.util.retry
 from client.multipart import MultipartEncoder
 import client.util
 
@@ -25,6 +33,21 @@ _CorelightRoot = os.path.join(os.path.dirname(__file__), "certs/corelight.pem")
 # client needs to be updated.
 _Version = 1
 
+# Content encodings we accept for responses. requests already asks for
+# gzip and deflate by default; this exists only to add brotli if a module
+# for decoding it is available.
+_AcceptEncoding = requests.packages.urllib3.util.make_headers(accept_encoding=True)["accept-encoding"]
+
+# Size of the chunks in which we read streamed response bodies.
+_StreamChunkSize = 64 * 1024
+
+# Size of the blocks in which connections read request bodies, such as
+# file uploads, for sending.
+_SendBlockSize = 1024 * 1024
+
+# Whitespace allowed between JSON tokens.
+_JSONWhitespace = re.compile(r"[ \t\n\r]*")
+
 requests.packages.urllib3.disable_warnings()
 
 class SessionError(Exception):
@@ -38,13 +61,84 @@ class SessionError(Exception):
         """Triggers a fatal error reporting  the exception's information."""
         client.util.fatalError(self._msg, self._arg)
 
+class _SessionCachingSocket(ssl.SSLSocket):
+    """SSL socket handing its TLS session back to its context when closed."""
+    def close(self):
+        self.context._rememberSession(self)
+        super(_SessionCachingSocket, self).close()
+
+class _SessionCachingContext(ssl.SSLContext):
+    """
+    SSL context remembering the most recent TLS session for each server it
+    connects to, so that further connections to the same server resume
+    that session with an abbreviated handshake.
+
+    A connection's session is remembered both after the handshake and
+    when closing the connection, as with TLS 1.3 the server sends its
+    session tickets only after the handshake.
+    """
+    sslsocket_class = _SessionCachingSocket
+
+    def __init__(self, protocol):
+        # Maps (server hostname, peer address) to an SSLSession.
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        """Overridden from base class to resume a previous session with the same server."""
+        key = (kwargs.get("server_hostname", None), sock.getpeername()[:2])
+
+        with self._sessions_lock:
+            session = self._sessions.get(key, None)
+
+        if session and not kwargs.get("session", None):
+            kwargs["session"] = session
+
+        ssl_sock = super(_SessionCachingContext, self).wrap_socket(sock, *args, **kwargs)
+        ssl_sock.session_key = key
+        self._rememberSession(ssl_sock)
+        return ssl_sock
+
+    def _rememberSession(self, ssl_sock):
+        """Records a connection's TLS session for later resumption, if the server allows that."""
+        try:
+            session = ssl_sock.session
+
+            if not session:
+                return
+
+            if ssl_sock.version() == "TLSv1.3":
+                # Resumption requires a ticket.
+                resumable = session.has_ticket
+            else:
+                resumable = (session.has_ticket or len(session.id) > 0)
+
+        except (AttributeError, ValueError, OSError):
+            return
+
+        if resumable:
+            with self._sessions_lock:
+                self._sessions[ssl_sock.session_key] = session
+
 # requests adaptor giving more control over certificate validation.
 # Adapted from http://docs.python-requests.org/en/master/user/advanced/#transport-adapters
 class _SSLAdapter(requests.adapters.HTTPAdapter):
     def __init__(self, args, *adapter_args, **adapter_kwargs):
+        # All of the adapter's connections share one context, so that they
+        # can resume each other's TLS sessions. Certificate and hostname
+        # checks are configured per connection, see cert_verify().
+        self._ssl_context = _SessionCachingContext(ssl.PROTOCOL_TLS_CLIENT)
+        self._ssl_context.check_hostname = False
+        self._ssl_context.options |= ssl.OP_NO_COMPRESSION
+
         requests.adapters.HTTPAdapter.__init__(self, *adapter_args, **adapter_kwargs)
         self._args = args
 
+    def init_poolmanager(self, *args, **kwargs):
+        """Overridden from base class to use our SSL context for all connections."""
+        kwargs["ssl_context"] = self._ssl_context
+        super(_SSLAdapter, self).init_poolmanager(*args, **kwargs)
+
     def cert_verify(self, conn, url, verify, cert):
         """Overridden from base class to control certificate validation."""
         ssl_ca_cert = self._args.ssl_ca_cert
@@ -91,7 +185,7 @@ class _SSLAdapter(requests.adapters.HTTPAdapter):
 
 class _UnixSocketConnection(requests.packages.urllib3.connection.HTTPConnection):
     def __init__(self, args, host_address):
-        super(_UnixSocketConnection, self).__init__(host_address, timeout=None)
+        super(_UnixSocketConnection, self).__init__(host_address, timeout=None, blocksize=_SendBlockSize)
         self.sock = None
         self._args = args
     
@@ -104,27 +198,60 @@ class _UnixSocketConnection(requests.packages.urllib3.connection.HTTPConnection)
         client.util.debug("sock = sock.socket(AF_UNIX, SOCK_STREAM)")
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         client.util.debug("sock.connect('{}')".format(self._args.socket))
+        sock.settimeout(self.timeout)
         sock.connect(self._args.socket)
         self.sock = sock
 
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        """Overridden from base class to send multipart bodies through sendfile()."""
+        if not isinstance(body, MultipartEncoder):
+            return super(_UnixSocketConnection, self).request(method, url, body=body, headers=headers, **kwargs)
+
+        # The headers include the body's length, so we can send it separately.
+        super(_UnixSocketConnection, self).request(method, url, body=None, headers=headers, **kwargs)
+        body.send_to(self.sock)
+
+class _HTTPConnectionPool(requests.packages.urllib3.connectionpool.HTTPConnectionPool):
+    def _new_conn(self):
+        """Overridden from base class to send request bodies in larger blocks."""
+        conn = super(_HTTPConnectionPool, self)._new_conn()
+        conn.blocksize = _SendBlockSize
+        return conn
+
 class _HTTPSConnectionPool(requests.packages.urllib3.connectionpool.HTTPSConnectionPool):
+    def _new_conn(self):
+        """Overridden from base class to send request bodies in larger blocks."""
+        conn = super(_HTTPSConnectionPool, self)._new_conn()
+        conn.blocksize = _SendBlockSize
+        return conn
+
     def _validate_conn(self, conn):
         """Overridden from base class to get access to the server-side certificate."""
+        connecting = not getattr(conn, "sock", None)
+
         super(_HTTPSConnectionPool, self)._validate_conn(conn)
 
+        if connecting and client.util.debugLevel():
+            try:
+                handshake = ("resumed session" if conn.sock.session_reused else "full handshake")
+                client.util.debug("+ {} connection to {}:{}, {}".format(conn.sock.version(), self.host, self.port, handshake))
+            except AttributeError:
+                pass
+
         try:
             conn.peer_certificate = conn.sock.getpeercert()
         except:
             conn.peer_certificate = None
 
-# Patch our custom class into the pool manager.
+# Patch our custom classes into the pool manager.
+requests.packages.urllib3.poolmanager.pool_classes_by_scheme["http"] = _HTTPConnectionPool
 requests.packages.urllib3.poolmanager.pool_classes_by_scheme["https"] = _HTTPSConnectionPool
 
 class _UnixSocketConnectionPool(requests.packages.urllib3.connectionpool.HTTPConnectionPool):
-    def __init__(self, args, host_address):
+    def __init__(self, args, host_address, maxsize=1):
         self._host_address = host_address
         super(_UnixSocketConnectionPool, self).__init__(
-            self._host_address, timeout=None)
+            self._host_address, timeout=None, maxsize=maxsize)
         self._args = args
 
     def _new_conn(self):
@@ -132,18 +259,231 @@ class _UnixSocketConnectionPool(requests.packages.urllib3.connectionpool.HTTPCon
 
 
 class _UnixSocketAdapter(requests.adapters.HTTPAdapter):
-    def __init__(self, args, host_address):
-        super(_UnixSocketAdapter, self).__init__()
-        self._unix_connection_pool = _UnixSocketConnectionPool(args, host_address)
+    def __init__(self, args, host_address, pool_maxsize=1, max_retries=0):
+        super(_UnixSocketAdapter, self).__init__(max_retries=max_retries)
+        self._unix_connection_pool = _UnixSocketConnectionPool(args, host_address, maxsize=pool_maxsize)
 
     def get_connection(self, url, proxies=None):
         return self._unix_connection_pool
 
+class _Retry(requests.packages.urllib3.util.retry.Retry):
+    """
+    Retry policy for requests. Only requests that are safe to repeat are
+    retried after errors, or when the device answers that it's overloaded
+    (429/503). Waits between attempts grow exponentially with random
+    jitter, unless the device asks for a specific wait through
+    ``Retry-After``. Nothing is retried if the wait would run past an
+    overall deadline.
+    """
+    # Methods safe to repeat.
+    RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+    # Status codes to retry.
+    RETRY_STATUS = frozenset([429, 503])
+
+    def __init__(self, *args, **kwargs):
+        self.deadline = kwargs.pop("deadline", None)
+        super(_Retry, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def create(cls, retries, deadline=None):
+        """
+        Returns a new policy.
+
+        retries (int): The maximum number of times to retry a request.
+
+        deadline (float): Time in seconds since the epoch after which not
+        to retry anymore, or None for no limit.
+        """
+        kwargs = dict(total=retries, backoff_factor=0.5, status_forcelist=cls.RETRY_STATUS,
+                      respect_retry_after_header=True, raise_on_status=False,
+                      raise_on_redirect=False, deadline=deadline)
+
+        try:
+            return cls(allowed_methods=cls.RETRY_METHODS, **kwargs)
+        except TypeError:
+            # urllib3 < 1.26.
+            return cls(method_whitelist=cls.RETRY_METHODS, **kwargs)
+
+    def new(self, **kw):
+        """Overridden from base class to carry over the deadline."""
+        kw.setdefault("deadline", self.deadline)
+        return super(_Retry, self).new(**kw)
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        """Overridden from base class to report retries."""
+        retry = super(_Retry, self).increment(method, url, response, error, *args, **kwargs)
+        reason = (error if error else "status {}".format(response.status if response else "unknown"))
+        client.util.debug("Retrying {} {} ({})".format(method, url, reason))
+        return retry
+
+    def get_backoff_time(self):
+        """Overridden from base class to add jitter."""
+        backoff = super(_Retry, self).get_backoff_time()
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def sleep(self, response=None):
+        """Overridden from base class to respect the deadline."""
+        delay = None
+
+        if response and self.respect_retry_after_header:
+            delay = self.get_retry_after(response)
+
+        if delay is None:
+            delay = self.get_backoff_time()
+
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            raise SessionError("timeout exceeded while retrying a failed request")
+
+        if delay > 0:
+            time.sleep(delay)
+
+def _drainConnection(conn):
+    """
+    Processes any TLS records a server has sent on an idle connection, such
+    as TLS 1.3 session tickets. urllib3 would otherwise take the pending
+    data as the connection having been closed, and reconnect.
+
+    conn (urllib3.connection.HTTPConnection): The connection.
+    """
+    sock = getattr(conn, "sock", None)
+
+    if not isinstance(sock, ssl.SSLSocket):
+        return
+
+    timeout = sock.gettimeout()
+
+    try:
+        sock.settimeout(0)
+
+        if sock.recv(1):
+            # Unexpected data from the server; don't reuse the connection.
+            conn.close()
+
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+        pass
+
+    except OSError:
+        conn.close()
+
+    finally:
+        if conn.sock:
+            sock.settimeout(timeout)
+
+def _iterateCollection(response, url):
+    """
+    Incrementally decodes a response body consisting of a JSON list,
+    yielding the list's elements as they arrive. Only the element currently
+    being decoded is kept in memory. The response is closed once done.
+
+    If the body is not a valid JSON list, or reading it fails, the function
+    raises a ``SessionError`` once it gets to the problem.
+
+    response (requests.Response): The response, retrieved with ``stream=True``.
+
+    url (str): The URL the response is for, for error messages.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf8")()
+    chunks = response.iter_content(_StreamChunkSize)
+    state = {"buf": "", "pos": 0, "eof": False}
+
+    def more():
+        # Appends the next chunk to the buffer, dropping what's been
+        # consumed already. Returns False at the end of the body.
+        if state["eof"]:
+            return False
+
+        try:
+            chunk = next(chunks)
+            text = utf8.decode(chunk)
+        except StopIteration:
+            state["eof"] = True
+            text = utf8.decode(b"", final=True)
+        except UnicodeDecodeError:
+            raise SessionError("Cannot decode JSON body of response", url, response.status_code)
+        except requests.RequestException as e:
+            raise SessionError("cannot retrieve URL from Corelight device", e)
+
+        state["buf"] = state["buf"][state["pos"]:] + text
+        state["pos"] = 0
+        return True
+
+    def skip():
+        # Moves past whitespace, returning the next character or None at
+        # the end of the body.
+        while True:
+            state["pos"] = _JSONWhitespace.match(state["buf"], state["pos"]).end()
+
+            if state["pos"] < len(state["buf"]):
+                return state["buf"][state["pos"]]
+
+            if not more():
+                return None
+
+    def expect(chars):
+        c = skip()
+
+        if c is None or c not in chars:
+            raise SessionError("Cannot decode JSON body of response", url, response.status_code)
+
+        state["pos"] += 1
+        return c
+
+    try:
+        if skip() != "[":
+            raise SessionError("server sent a collection that's not a list", url, response.status_code)
+
+        state["pos"] += 1
+
+        if skip() == "]":
+            state["pos"] += 1
+            c = None
+        else:
+            c = ","
+
+        while c == ",":
+            skip()
+
+            while True:
+                (buf, pos) = (state["buf"], state["pos"])
+
+                try:
+                    (obj, end) = decoder.raw_decode(buf, pos)
+
+                    # A number may continue in the next chunk unless we
+                    # see what follows it.
+                    if buf[pos] in "{[\"" or (end < len(buf) and buf[end] in ",] \t\n\r") or not more():
+                        break
+
+                except ValueError:
+                    if not more():
+                        raise SessionError("Cannot decode JSON body of response", url, response.status_code)
+
+            state["pos"] = end
+            yield obj
+
+            c = expect(",]")
+
+        if skip() is not None:
+            raise SessionError("Cannot decode JSON body of response", url, response.status_code)
+
+    finally:
+        response.close()
+
+def _rewindFiles(files):
+    """
+    Moves all files to be uploaded back to their start.
+
+    files (dict): Form fields in the format of the ``requests`` ``files``
+    argument, or None.
+    """
+    for file in (files or {}).values():
+        if len(file) > 1 and hasattr(file[1], "seek"):
+            file[1].seek(0)
+
 class Session:
     """Class issueing HTTP requests to the Corelight Sensor device."""
-    # The joint requests.Session object used for all requests. Created on first use.
-    _RequestsSession = None
-
     def __init__(self, args):
         """
         Constructor.
@@ -155,19 +495,129 @@ class Session:
         
         self.socket_pool = None
 
-        if not Session._RequestsSession:
-            Session._RequestsSession = requests.Session()
-            if self._args.socket:
-                socket_adapter = _UnixSocketAdapter(self._args, "localhost")
-                Session._RequestsSession.mount('http://', socket_adapter)
-                Session._RequestsSession.mount('https://', socket_adapter)
-            else:
-                Session._RequestsSession.mount('https://', _SSLAdapter(self._args))
+        # Keep enough connections around for concurrent meta data requests
+        # and batch commands.
+        pool_maxsize = max(requests.adapters.DEFAULT_POOLSIZE, getattr(self._args, "meta_workers", 1),
+                           getattr(self._args, "batch_concurrency", 1))
+
+        # The requests.Session object used for all of this session's
+        # requests, holding on to its connections.
+        self._requests = requests.Session()
+        if self._args.socket:
+            socket_adapter = _UnixSocketAdapter(self._args, "localhost", pool_maxsize=pool_maxsize)
+            self._requests.mount('http://', socket_adapter)
+            self._requests.mount('https://', socket_adapter)
+        else:
+            self._requests.mount('https://', _SSLAdapter(self._args, pool_maxsize=pool_maxsize))
+
+        # Time in seconds since the epoch by which all requests need to
+        # be done, if any; see setTimeout().
+        self._deadline = None
+        self._applyRetries()
+
+        # Background thread establishing a connection ahead of the first
+        # request, while running; see prewarm().
+        self._prewarm = None
+        self._prewarm_lock = threading.Lock()
+        self._prewarm_started = None
+        self._prewarm_connected = None
+        self._prewarm_conn = None
+
+        # Serializes logging into a Fleet Manager, and answering a
+        # sensor's 2FA challenge, so that concurrent requests share a
+        # single login. Reentrant, as logging in sends requests itself.
+        self._login_lock = threading.RLock()
+
+    def prewarm(self, url):
+        """
+        Starts connecting to the server of a URL in a background thread, so
+        that the connection is already established by the time the first
+        request goes out. Requests wait for the connection attempt to
+        finish before proceeding, and then reuse the connection. Any errors
+        are left for the requests to report.
+
+        url (str): The URL whose server to connect to.
+        """
+        with self._prewarm_lock:
+            if self._prewarm:
+                return
+
+            self._prewarm_started = time.time()
+            self._prewarm_connected = None
+            self._prewarm = threading.Thread(target=self._connect, args=(url,), daemon=True)
+            self._prewarm.start()
+
+    def _connect(self, url):
+        """Establishes a pooled connection to the server of a URL."""
+        try:
+            proxies = self._requests.merge_environment_settings(url, {}, None, None, None)["proxies"]
+            adapter = self._requests.get_adapter(url)
+            pool = adapter.get_connection(url, proxies)
+            adapter.cert_verify(pool, url, True, None)
+            (connect_timeout, read_timeout) = self._timeouts()
+            conn = pool._get_conn()
+            conn.timeout = connect_timeout
+
+            try:
+                # Connects, and for HTTPS validates the server's certificate.
+                pool._validate_conn(conn)
+
+                if not getattr(conn, "sock", None):
+                    conn.connect()
+
+                self._prewarm_connected = time.time()
+                self._prewarm_conn = conn
+
+            finally:
+                pool._put_conn(conn)
+
+        except Exception:
+            pass
+
+    def _waitForPrewarm(self):
+        """Waits for a connection attempt started by prewarm() to finish."""
+        if not self._prewarm:
+            return
+
+        with self._prewarm_lock:
+            if not self._prewarm:
+                return
+
+            waiting = time.time()
+            self._prewarm.join()
+            self._prewarm = None
+
+            if self._prewarm_conn:
+                _drainConnection(self._prewarm_conn)
+                self._prewarm_conn = None
+
+        if self._prewarm_connected:
+            duration = self._prewarm_connected - self._prewarm_started
+            overlap = max(0, min(duration, waiting - self._prewarm_started))
+            client.util.debug("Connected in {:.1f}ms, {:.1f}ms of it in parallel with startup".format(duration * 1000, overlap * 1000))
+
+    def close(self):
+        """Closes all of the session's connections."""
+        self._waitForPrewarm()
+        self._requests.close()
 
     def arguments(self):
         """Returns the *ComponentArgumentParser* associated with the session."""
         return self._args
 
+    def withArguments(self, args):
+        """
+        Returns a view of the session that shares its connections and
+        credentials, but associates a different argument parser with
+        them. Unlike ``setArguments()``, this leaves the session itself
+        unchanged, so that views for different commands can be used
+        concurrently.
+
+        args (ComponentArgumentParser): The argument parser to associate
+        with the view.
+        """
+        return _SessionView(self, args)
+
     def setArguments(self, args):
         """
         Associates a different argument parser with the session.
@@ -176,6 +626,45 @@ class Session:
         with the session.
         """
         self._args = args
+        self._applyRetries()
+
+    def setTimeout(self, timeout):
+        """
+        Sets an overall deadline for all further requests. Once it has
+        passed, requests fail, and no more retries are attempted.
+
+        timeout (float): Seconds from now until the deadline. None or zero
+        removes the deadline.
+        """
+        self._deadline = (time.time() + timeout if timeout else None)
+        self._applyRetries()
+
+    def _applyRetries(self):
+        """Configures all transports with the current retry policy."""
+        retries = _Retry.create(getattr(self._args, "retries", 0), self._deadline)
+
+        for adapter in self._requests.adapters.values():
+            adapter.max_retries = retries
+
+    def _timeouts(self):
+        """
+        Returns the ``(connect, read)`` timeouts for the next request,
+        shortened so as to not run past the deadline. None means no
+        timeout.
+        """
+        connect = (getattr(self._args, "connect_timeout", None) or None)
+        read = (getattr(self._args, "read_timeout", None) or None)
+
+        if self._deadline is not None:
+            remaining = self._deadline - time.time()
+
+            if remaining <= 0:
+                raise SessionError("timeout exceeded", "{:g}s".format(getattr(self._args, "timeout", 0)))
+
+            connect = min(connect or remaining, remaining)
+            read = min(read or remaining, remaining)
+
+        return (connect, read)
 
     def _performFleetLogin(self, **kwargs):
         """
@@ -257,6 +746,13 @@ class Session:
 
         url (str): The full URL to retrieve.
 
+        If the keyword argument ``stream`` is true, a successful response
+        with a ``collection`` schema is decoded incrementally: instead of a
+        list, the 4th element of the result is then an iterator yielding
+        the list's elements as they arrive, which may raise a
+        ``SessionError`` as well. Other responses are read in full as
+        usual.
+
         All other keyword arguments are passed through to the
         corresponding ``requests`` methods.
 
@@ -271,7 +767,9 @@ class Session:
         """
 
         if self._args.fleet and not self._args.bearer_token:
-            self._performFleetLogin(**kwargs)
+            with self._login_lock:
+                if not self._args.bearer_token:
+                    self._performFleetLogin(**kwargs)
 
         response = self._retrieveURL(url, **kwargs)
         success = (response.status_code >= 200 and response.status_code < 300)
@@ -282,7 +780,23 @@ class Session:
         version = None
         data = None
 
-        if ty == "application" and st == "json":
+        if ty == "application" and st == "json" and success and params.get("schema", None) == "collection":
+            streaming = kwargs.get("stream", False)
+        else:
+            streaming = False
+
+        if kwargs.get("stream", False) and not streaming:
+            # Read the body right away so that the connection goes back
+            # into the pool.
+            try:
+                response.content
+            except requests.RequestException as e:
+                raise SessionError("cannot retrieve URL from Corelight device", e)
+
+        if streaming:
+            data = _iterateCollection(response, url)
+
+        elif ty == "application" and st == "json":
             try:
                 data = response.json()
             except:
@@ -333,49 +847,32 @@ class Session:
         """
         kwargs["method"] = kwargs.get("method", "GET")
 
+        self._waitForPrewarm()
+
         try:
             debug_level = kwargs["debug_level"]
             del kwargs["debug_level"]
         except KeyError:
             debug_level = 1
 
+        extra_headers = kwargs.pop("headers", None)
+        stream = kwargs.pop("stream", False)
+
         # Basic Auth cred not required if bearer token available
         if self._args.user and self._args.password and not self._args.fleet and not self._args.bearer_token:
             auth = (self._args.user, self._args.password)
         else:
             auth = None
-               
-        if auth:
-            req = requests.Request(url=url, headers=self._requestHeaders(), auth=auth, **kwargs)
-        else:
-            if "files" in kwargs :
-                if len(kwargs["files"]) == 1 and "/fleet/v1/sensor-update/images" in url:
-                    key = next(iter(kwargs["files"]))
-                    file = kwargs["files"][key]
-                    file_path = file[0]
-                    f = file[1]
-                    del kwargs["files"]
-                    multipart_data = MultipartEncoder(
-                        fields={
-                            key:(file_path, f, "application/octet-stream"),
-                            "filename": file_path
-                        }
-                    )
-                    new_headers = self._requestHeaders().copy()
-                    new_headers["Content-Type"]=multipart_data.content_type
-                    req = requests.Request(url=url, headers=new_headers, data=multipart_data, **kwargs)
-                else:
-                    # convert name to base 
-                    for key, file in kwargs["files"].items():
-                        lst = list(kwargs["files"][key])
-                        lst[0] = os.path.basename(file[0])
-                        kwargs["files"][key]=tuple(lst)
-                    req = requests.Request(url=url, headers=self._requestHeaders(), **kwargs)
-            else:
-                req = requests.Request(url=url, headers=self._requestHeaders(), **kwargs)
 
+        files = kwargs.pop("files", None)
 
-        prepared = Session._RequestsSession.prepare_request(req)
+        # The token that the request goes out with, to tell whether a 2FA
+        # challenge has been answered by another request since.
+        sent_token = self._args.bearer_token
+
+        req = self._buildRequest(url, auth, extra_headers, files, **kwargs)
+
+        prepared = self._requests.prepare_request(req)
 
         if client.util.debugLevel():
             client.util.debug("== {} {}".format(prepared.method, prepared.url), level=debug_level)
@@ -385,7 +882,11 @@ class Session:
 
             client.util.debug("| ", level=debug_level)
 
-            if prepared.body:
+            if isinstance(prepared.body, MultipartEncoder):
+                # Streamed from the files, don't read it here.
+                client.util.debug("| <multipart body with {} parts, {} bytes>".format(len(prepared.body.parts), prepared.body.len), level=debug_level)
+
+            elif prepared.body:
                 for line in prepared.body.splitlines():
                     if isinstance(line, bytes):
                         line = line.decode("utf8", "ignore")
@@ -393,7 +894,7 @@ class Session:
                     client.util.debug("| " + line, level=debug_level)
 
         try:
-            response = Session._RequestsSession.send(prepared)
+            response = self._requests.send(prepared, timeout=self._timeouts(), stream=stream)
 
             info = response.headers.get("X-INFO-MESSAGE", None)
             if info:
@@ -403,52 +904,25 @@ class Session:
 
             if info2faheader and info2faheader.startswith("BasicWith2fa"):
             
-                 # 2fa is enabled on the sensor hence we will retry with 2fa code
-                 # username password fields are constructed based on a agreed format 
-                 # username 2fa|<authtype>|<username>
-                 # password <passcode>|<password>
-                 mfaToken = self._args.mfa
-            
-                 # prompt for a 2fa token
-                 if mfaToken and mfaToken == "-" and (not self._args.noblock):
-                    mfaToken = client.util.getInput("Verification Code", password=True)
-
-                 # if no 2fa token provided  
-                 if mfaToken is None:
-                     raise SessionError("No 2FA token has been provided. Please provide a proper 2FA token and try again.")
-             
-                 # username has no authenticator type provided 
-                 if self._args.user.find("|") == -1:
-                    self._args.user = '2fa||' + self._args.user
-                 else:
-                    # username expected to be in format authenticator type|username
-                    # As authenticator type can be any custom name, we cannot place a check for that 
-                    self._args.user = '2fa|' + self._args.user
-
-                 self._args.password = mfaToken + '|' + self._args.password
-                 auth = (self._args.user, self._args.password)
-
-                 if auth:
-                     req = requests.Request(url=url, headers=self._requestHeaders(), auth=auth, **kwargs)
-                 else:
-                     req = requests.Request(url=url, headers=self._requestHeaders(), **kwargs)
-
-                 prepared = Session._RequestsSession.prepare_request(req)
-                 response = Session._RequestsSession.send(prepared)
-                 # Get the bearer token which will be valid for the entire session 
-                 info2faheader = response.headers.get("Authorization", None)
-                 if info2faheader and info2faheader.startswith("Bearer "):
-                     start = 'Bearer '
-                     sessionID = (info2faheader.split(start,1))[1]
-                     self._args.bearer_token = sessionID
-
-                 elif info2faheader and info2faheader.startswith("SessionID="):
-                     start = 'SessionID='
-                     sessionID = (info2faheader.split(start,1))[1]
-                     self._args.bearer_token = sessionID
-
-                 else:
-                     raise SessionError("cannot get 2fa session from device")
+                 # 2fa is enabled on the sensor hence we will retry with 2fa code.
+                 # Concurrent requests share a single challenge: whoever comes
+                 # second reuses the session that the first one obtained. A
+                 # token that was already in place has drawn the challenge
+                 # itself, so that one is not tried again.
+                 with self._login_lock:
+                     # The first attempt has consumed any files; send them again from the start.
+                     _rewindFiles(files)
+
+                     # Read the challenge's body so that its connection can be reused.
+                     response.content
+
+                     if self._args.bearer_token and self._args.bearer_token != sent_token:
+                         req = self._buildRequest(url, None, extra_headers, files, **kwargs)
+                         prepared = self._requests.prepare_request(req)
+                         response = self._requests.send(prepared, timeout=self._timeouts(), stream=stream)
+
+                     else:
+                         response = self._retrieve2faSession(url, extra_headers, files, stream, **kwargs)
  
         except requests.exceptions.SSLError as e:
             u = urllib.parse.urlparse(url)
@@ -456,8 +930,20 @@ class Session:
 
         except requests.ConnectionError as e:
             u = urllib.parse.urlparse(url)
+
+            # Running out of retries after read timeouts ends up here, too.
+            if isinstance(getattr(e.args[0] if e.args else None, "reason", None), requests.packages.urllib3.exceptions.ReadTimeoutError):
+                raise SessionError("Corelight device at {} did not respond in time".format(u.netloc), e)
+
             raise SessionError("cannot connect to Corelight device at {}".format(u.netloc), e)
 
+        except requests.exceptions.ReadTimeout as e:
+            u = urllib.parse.urlparse(url)
+            raise SessionError("Corelight device at {} did not respond in time".format(u.netloc), e)
+
+        except SessionError:
+            raise
+
         except Exception as e:
             raise SessionError("cannot retrieve URL from Corelight device", e)
 
@@ -485,6 +971,11 @@ class Session:
                 for line in response.content.splitlines():
                     client.util.debug("| " + line.decode("utf8"), level=debug_level)
 
+                encoding = response.headers.get("Content-Encoding", None)
+
+                if encoding:
+                    client.util.debug("+ Body: {} bytes received ({}), {} bytes decoded".format(response.raw.tell(), encoding, len(response.content)), level=debug_level)
+
         # This check can help ensure that the SSL certificate wasn't accidently copied to another sensor.
         # We do this by verifying that the SSL cert matches the identity that the sensor believes it should be.
         if cert and not self._args.ssl_ca_cert and not self._args.ssl_no_verify_certificate and not self._args.ssl_no_verify_hostname and not self._args.fleet:
@@ -517,6 +1008,110 @@ class Session:
 
         return response
 
+    def _retrieve2faSession(self, url, extra_headers, files, stream, **kwargs):
+        """
+        Answers a sensor's 2FA challenge by sending a request again with
+        the verification code, and takes the bearer token for the rest of
+        the session from the response. Must be called with
+        ``_login_lock`` held.
+
+        url (str): The full URL to request.
+
+        extra_headers (dict of str to str): Headers to add to the default
+        ones, or None.
+
+        files (dict): Form fields to upload, or None.
+
+        stream (bool): True to not read the response's body right away.
+
+        All other keyword arguments are passed through to
+        ``requests.Request``.
+
+        Returns: The ``requests.Response`` to the repeated request.
+        """
+        mfaToken = self._args.mfa
+
+        # prompt for a 2fa token
+        if mfaToken and mfaToken == "-" and (not self._args.noblock):
+            mfaToken = client.util.getInput("Verification Code", password=True)
+
+        # if no 2fa token provided  
+        if mfaToken is None:
+            raise SessionError("No 2FA token has been provided. Please provide a proper 2FA token and try again.")
+
+        # username has no authenticator type provided 
+        if self._args.user.find("|") == -1:
+            user = '2fa||' + self._args.user
+        else:
+            # username expected to be in format authenticator type|username
+            # As authenticator type can be any custom name, we cannot place a check for that 
+            user = '2fa|' + self._args.user
+
+        password = mfaToken + '|' + self._args.password
+
+        req = self._buildRequest(url, (user, password), extra_headers, files, **kwargs)
+        prepared = self._requests.prepare_request(req)
+        response = self._requests.send(prepared, timeout=self._timeouts(), stream=stream)
+
+        # Get the bearer token which will be valid for the entire session 
+        info2faheader = response.headers.get("Authorization", None)
+        if info2faheader and info2faheader.startswith("Bearer "):
+            start = 'Bearer '
+            sessionID = (info2faheader.split(start,1))[1]
+            self._args.bearer_token = sessionID
+
+        elif info2faheader and info2faheader.startswith("SessionID="):
+            start = 'SessionID='
+            sessionID = (info2faheader.split(start,1))[1]
+            self._args.bearer_token = sessionID
+
+        else:
+            raise SessionError("cannot get 2fa session from device")
+
+        return response
+
+    def _buildRequest(self, url, auth, extra_headers, files, **kwargs):
+        """
+        Creates a request to send. Files are uploaded through a streaming
+        ``multipart/form-data`` body with a known length, so that they are
+        never read into memory as a whole.
+
+        url (str): The full URL to request.
+
+        auth (tuple): User name and password for basic authentication, or
+        None.
+
+        extra_headers (dict of str to str): Headers to add to the default
+        ones, or None.
+
+        files (dict): Form fields to upload, in the format of the
+        ``requests`` ``files`` argument, or None.
+
+        All other keyword arguments are passed through to
+        ``requests.Request``.
+
+        Returns: A new ``requests.Request``.
+        """
+        headers = self._requestHeaders(extra_headers)
+
+        if not files:
+            return requests.Request(url=url, headers=headers, auth=auth, **kwargs)
+
+        if len(files) == 1 and "/fleet/v1/sensor-update/images" in url:
+            # Sensor images come with their original path.
+            key = next(iter(files))
+            (file_path, f) = files[key][:2]
+            fields = {
+                key: (file_path, f, "application/octet-stream"),
+                "filename": file_path
+                }
+        else:
+            fields = [(key, (os.path.basename(file[0]),) + tuple(file[1:])) for (key, file) in files.items()]
+
+        body = MultipartEncoder(fields=fields)
+        headers["Content-Type"] = body.content_type
+        return requests.Request(url=url, headers=headers, auth=auth, data=body, **kwargs)
+
     def _parseContentType(self, response, ignore_errors=False):
         """Parses a Content-Type header from an HTTP response.
 
@@ -560,17 +1155,36 @@ class Session:
 
             raise SessionError("Cannot parse Content-Type", ct)
 
-    def _requestHeaders(self):
+    def _requestHeaders(self, extra_headers=None):
         """
         Returns a pre-populated dictionary of headers we add to all
         outgoing HTTP requests.
+
+        extra_headers (dict of str to str): Additional headers to include.
         """
         headers = {
             "User-Agent": "{} v{}".format(client.NAME, client.VERSION),
-            "Accept": "application/json"
+            "Accept": "application/json",
+            "Accept-Encoding": _AcceptEncoding
             }
 
         if self._args.bearer_token:
             headers["Authorization"] = "Bearer {}".format(self._args.bearer_token)
 
+        if extra_headers:
+            headers.update(extra_headers)
+
         return headers
+
+class _SessionView:
+    """A session with its own arguments; see ``Session.withArguments()``."""
+    def __init__(self, session, args):
+        self._session = session
+        self._args = args
+
+    def arguments(self):
+        """Returns the *ComponentArgumentParser* associated with the view."""
+        return self._args
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
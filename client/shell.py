@@ -0,0 +1,167 @@
+# Copyright (c) 2017, Corelight. All rights reserved.
+#
+# See COPYING for license information.
+#
+# An interactive shell running commands against one device, sharing one
+# authenticated session, its connections, and one set of meta data
+# between them.
+#
+# Each line entered is split like a shell would and run like the
+# arguments of a separate invocation, with the global options given on
+# the command line applying to all of them. Errors, including those that
+# would otherwise terminate the client, return to the prompt. If
+# available, readline provides line editing, a history that persists
+# across shells, and completion of commands and their options.
+
+import os
+import shlex
+import sys
+
+import client.util
+
+from client.configuration import StateDir
+
+try:
+    import readline
+except ImportError:
+    # Not available on all platforms; we then go without line editing.
+    readline = None
+
+# File where to keep the history of commands entered.
+HistoryFile = os.path.join(StateDir, "shell_history")
+
+# Maximum number of commands to keep in the history.
+_HistoryLength = 1000
+
+# Commands that leave the shell.
+_ExitCommands = ("exit", "quit")
+
+def run(prompt, parse, execute, complete=None):
+    """
+    Runs the shell until the user leaves it.
+
+    prompt (str): The prompt to show for each command.
+
+    parse (callable): Function receiving a command's list of arguments,
+    returning an object that represents the parsed command. Errors
+    terminate the function through ``SystemExit``.
+
+    execute (callable): Function receiving an object returned by *parse*
+    and running the command. Errors terminate the function through
+    ``SystemExit``.
+
+    complete (callable): Function receiving the list of complete words
+    preceding the one being entered, returning a list of candidate words
+    to complete it with. If None, there's no completion.
+
+    Returns: The exit status of the last command run.
+    """
+    if not sys.stdin.isatty():
+        client.util.fatalError("the shell requires an interactive terminal")
+
+    if readline:
+        _setupReadline(complete)
+
+    status = 0
+
+    try:
+        while True:
+            try:
+                line = input(prompt)
+            except KeyboardInterrupt:
+                print()
+                continue
+            except EOFError:
+                print()
+                break
+
+            try:
+                argv = shlex.split(line)
+            except ValueError as e:
+                client.util.error("cannot parse command", e)
+                status = 2
+                continue
+
+            if not argv:
+                continue
+
+            if argv[0] in _ExitCommands:
+                break
+
+            status = _runCommand(parse, execute, argv)
+
+    finally:
+        if readline:
+            _saveHistory()
+
+    return status
+
+def _runCommand(parse, execute, argv):
+    """
+    Parses and runs a command, turning errors into an exit status rather
+    than letting them terminate the shell.
+
+    Returns: The command's exit status.
+    """
+    try:
+        execute(parse(argv))
+        return 0
+
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return (e.code or 0)
+
+        # Same as the interpreter does for a non-integer exit status.
+        print(e.code, file=sys.stderr)
+        return 1
+
+    except KeyboardInterrupt:
+        print()
+        return 130
+
+    except Exception as e:
+        client.util.error("command failed", e)
+        return 1
+
+def _setupReadline(complete):
+    """Sets up line editing, the history, and completion."""
+    try:
+        readline.read_history_file(HistoryFile)
+    except IOError:
+        # No history yet.
+        pass
+
+    readline.set_history_length(_HistoryLength)
+
+    if not complete:
+        return
+
+    matches = []
+
+    def completer(text, state):
+        if state == 0:
+            line = readline.get_line_buffer()[:readline.get_begidx()]
+
+            try:
+                words = shlex.split(line)
+            except ValueError:
+                # Within an unterminated quote.
+                words = None
+
+            matches[:] = ([w for w in complete(words) if w.startswith(text)] if words is not None else [])
+
+        return (matches[state] + " " if state < len(matches) else None)
+
+    readline.set_completer_delims(" \t\n")
+    readline.set_completer(completer)
+
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")
+    else:
+        readline.parse_and_bind("tab: complete")
+
+def _saveHistory():
+    try:
+        readline.write_history_file(HistoryFile)
+    except IOError as e:
+        client.util.error("cannot save shell history", e)
@@ -2,8 +2,17 @@
 #
 # See COPYING for license information.
 
+import contextlib
 import getpass
+import os
 import sys
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on all platforms; we then don't lock.
+    fcntl = None
 
 # Debug level. See ``enableDebug()`` for values.
 _DebugLevel = 0
@@ -78,6 +87,66 @@ def appendUrl(baseUrl, appendedPath):
 
     return baseUrl + appendedPath
 
+def writeFile(path, data, mode=None):
+    """
+    Atomically replaces a file's content. The data is written to a
+    temporary file in the same directory first, which is then renamed into
+    place, so that readers always see either the old or the new content.
+
+    path (str): The full path of the file to write.
+
+    data (bytes or iterable of bytes): The new content, either in one
+    piece or as a sequence of chunks to write one after the other.
+
+    mode (int): Permissions for the file. If None, the default
+    permissions for new files apply.
+    """
+    tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex[:12])
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, (mode if mode is not None else 0o666))
+
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = (data,)
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            for chunk in data:
+                fp.write(chunk)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(tmp, path)
+
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+        raise
+
+@contextlib.contextmanager
+def lockFile(path):
+    """
+    Context manager holding an exclusive advisory lock associated with a
+    file while executing its body, waiting for other processes to release
+    it first if necessary. The lock is placed on a separate file with
+    ``.lock`` appended to *path*, which is created if needed.
+
+    path (str): The full path of the file to lock.
+    """
+    if not fcntl:
+        yield
+        return
+
+    with open(path + ".lock", "a") as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
 def formatTuples(tuples):
     """
     Renders a list of 2-tuples into a column-aligned string format.